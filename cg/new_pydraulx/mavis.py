@@ -2,7 +2,15 @@
     Low-Level Communication with the Mavis API.
 """
 
+import re
+import sys
+import threading
+import Queue
+import urllib
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
 import json
 
 class Mavis(object):
@@ -10,14 +18,54 @@ class Mavis(object):
     session = None
     """The encrypted session cookie identifying this particular Mavis instance."""
 
-    def __init__(self, username, password, host = 'localhost', port = '3000', loginUrl = 'api/Users/login'):
+    http = None
+    """A pooled, keep-alive requests.Session shared by every query of this Mavis instance."""
+
+    timeout = 30
+    """Seconds to wait for Mavis to respond before raising MavisError."""
+
+    maxUrlLength = 2000
+    """Longest URL a batched lookup sends - longer lists are split across several requests."""
+
+    projectRelation = 'projectEntity'
+    """
+        LoopBack relation from an entity to its project entity, included by `prefetch`.
+        Servers whose models do not define it get getProject's result under this key instead.
+    """
+
+    parentRelation = 'parent'
+    """
+        LoopBack relation from an entity to its parent entity, included by `prefetch`
+        where the server's models define it.
+    """
+
+    prefetchDepth = 4
+    """How many levels of the parent chain `prefetch` includes."""
+
+    relations = True
+    """Whether `prefetch` asks for relations - cleared once the server rejects them."""
+
+    undefinedRelation = re.compile(r'Relation "?\w+"? is not defined')
+    """Matches LoopBack's error for an include of a relation its models do not define."""
+
+    def __init__(self, username, password, host = 'localhost', port = '3000', loginUrl = 'api/Users/login',
+                 poolSize = 10, timeout = 30):
         """
             Please see the docs concerning Mavis authentication.
+
+            `poolSize` is the number of keep-alive connections kept open to Mavis,
+            `timeout` the number of seconds to wait on any single request.
         """
 
         self.host = host
         self.port = port
         self.username = username
+        self.timeout = timeout
+        self.http = self._createSession(poolSize)
+        self.workers = MavisPool(poolSize)
+        self.__cookieLock = threading.Lock()
+        self.__inFlight = {}
+        self.__inFlightLock = threading.Lock()
 
         self.query('post', loginUrl, {'password':password, 'username': username})
 
@@ -37,23 +85,198 @@ class Mavis(object):
         """ DELETE """
         return self.query('delete', path, data = None, **params).json()
 
-    def getEntity(self, entityId):
-        query_filter = '?filter[include]=publishes'
-        url = '/api/Entities/' + str(entityId) + query_filter
-        return self.get(url)
+    def getEntity(self, entityId, prefetch = False, fields = None):
+        """
+            Get an entity and its publishes by id.
+
+            `prefetch` also includes its project and parent chain in the same request,
+            under the projectRelation and parentRelation keys. `fields` limits the keys
+            returned - keep any foreign keys the included relations rely on.
+        """
+        url = '/api/Entities/' + str(entityId)
+        if prefetch: return self._prefetch(url, fields)
+        return Mavis.get(self, url, filter = self._entityFilter(False, fields))
 
     def getProject(self, projectNameStr):
         query_filter = '?filter[where][templateType]=project'
         query_filter += '&filter[where][name]=' + projectNameStr
         url = '/api/Entities/findOne' + query_filter
 
-        return self.get(url)
+        return Mavis.get(self, url)
+
+    def entityForPath(self, entityPath, prefetch = False, fields = None):
+        """
+            Get the entity at entityPath - see getEntity for `prefetch` and `fields`.
+        """
+        if not prefetch and not fields:
+            query_filter = '?filter[where][path]=' + entityPath
+            url =   '/api/Entities/findOne' + query_filter
+
+            return Mavis.get(self, url)
+
+        url = '/api/Entities/findOne'
+        if prefetch: return self._prefetch(url, fields, {'path': entityPath})
+        return Mavis.get(self, url, filter = self._entityFilter(False, fields, {'path': entityPath}))
+
+    def _prefetch(self, url, fields = None, where = None):
+        """
+            Get an entity with its relations included - or, when the server's models do
+            not define them, get it plainly and its project by name (see getProject).
+        """
+
+        # call Mavis.get directly - subclasses may return futures from `get`.
+        if self.relations:
+            try:
+                return Mavis.get(self, url, filter = self._entityFilter(True, fields, where))
+            except MavisError as e:
+                # LoopBack rejects includes of undefined relations - stop asking. Any
+                # other error (e.g. Mavis unreachable) says nothing about the models.
+                if not self.undefinedRelation.search(str(e)): raise
+                self.relations = False
+
+        entity = Mavis.get(self, url, filter = self._entityFilter(False, fields, where))
+        if entity and 'error' not in entity and entity.get('project'):
+            project = Mavis.getProject(self, entity['project'])
+            if project and 'error' not in project: entity[self.projectRelation] = project
+
+        return entity
+
+    def _entityFilter(self, prefetch = False, fields = None, where = None):
+        """
+            Stringified LoopBack filter including publishes and, when prefetching,
+            the project and parent chain - optionally projected onto `fields`.
+        """
+
+        include = ['publishes']
+        if prefetch:
+            parents = self.parentRelation
+            for i in xrange(self.prefetchDepth - 1):
+                parents = {self.parentRelation: parents}
+            include += [self.projectRelation, parents]
+
+        entityFilter = {'include': include}
+        if fields: entityFilter['fields'] = list(fields)
+        if where: entityFilter['where'] = where
+
+        return json.dumps(entityFilter)
+
+    def close(self):
+        """
+            Close all pooled connections to Mavis.
+        """
+        self.http.close()
+
+    def _createSession(self, poolSize):
+        """
+            Build the keep-alive session all queries share, so sequential calls reuse
+            open connections instead of paying for a new TCP handshake each time.
+        """
+
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections = poolSize, pool_maxsize = poolSize)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
+
+    def entitiesForPaths(self, entityPaths):
+        """
+            Look up many entities by path in as few round trips as possible.
+
+            Returns a dict of path to entity - paths unknown to Mavis are left out.
+        """
+        return self._findWhereIn('path', entityPaths)
+
+    def entitiesForIds(self, entityIds):
+        """
+            Look up many entities by id in as few round trips as possible.
+
+            Returns a dict of id to entity - ids unknown to Mavis are left out.
+        """
+        return self._findWhereIn('id', entityIds)
+
+    def iterate(self, path, where = None, pageSize = 100, prefetch = 2, order = 'id ASC'):
+        """
+            Yield the entities of a collection (e.g. '/api/Entities') one at a time,
+            paging with filter[limit] / filter[skip] instead of fetching it whole.
+
+            The next `prefetch` pages are requested concurrently while the current page
+            is consumed, so only a few pages are ever held in memory. `order` must give
+            a stable ordering for paging to be consistent.
+        """
+
+        def fetch(page):
+            pageFilter = {'limit': pageSize, 'skip': page * pageSize, 'order': order}
+            if where: pageFilter['where'] = where
+
+            # call Mavis.get directly - subclasses may return futures from `get`.
+            return Mavis.get(self, path, filter = json.dumps(pageFilter))
+
+        pending = [self.workers.submit(fetch, page) for page in xrange(prefetch + 1)]
+        nextPage = prefetch + 1
+
+        while pending:
+            entities = pending.pop(0).result()
+
+            # a 404 passes through as an error dict rather than a list.
+            if not isinstance(entities, list): return
+
+            # a short page is the last one - anything still pending is past the end.
+            if len(entities) < pageSize: pending = []
+            else:
+                pending.append(self.workers.submit(fetch, nextPage))
+                nextPage += 1
+
+            for entity in entities:
+                yield entity
+
+    def _findWhereIn(self, field, values):
+        """
+            Fetch all entities whose `field` is in values using LoopBack `inq` filters,
+            one request per URL-length-limited chunk, with chunks sent concurrently.
+        """
+
+        if not values: return {}
+
+        url = '/api/Entities'
+        chunks = self._inqChunks(url, field, values)
 
-    def entityForPath(self, entityPath):
-        query_filter = '?filter[where][path]=' + entityPath
-        url =   '/api/Entities/findOne' + query_filter
+        # call Mavis.get directly - subclasses may return futures from `get`.
+        fetch = lambda params: Mavis.get(self, url, **params)
+        if len(chunks) == 1: results = [fetch(chunks[0])]
+        else: results = self.workers.map(fetch, chunks)
 
-        return self.get(url)
+        entities = {}
+        for result in results:
+            # a 404 passes through as an error dict rather than a list.
+            if not isinstance(result, list): continue
+            for entity in result:
+                entities[entity[field]] = entity
+
+        return entities
+
+    def _inqChunks(self, url, field, values):
+        """
+            Split values into stringified LoopBack `filter` params of the form
+            {"where": {field: {"inq": [...]}}}, keeping each URL under maxUrlLength.
+        """
+
+        # the URL and filter without any values, then each value's encoded length.
+        emptyFilter = urllib.urlencode({'filter': json.dumps({'where': {field: {'inq': []}}})})
+        baseLength = len(''.join(['http://', self.host, ':', self.port, url, '?', emptyFilter]))
+
+        chunks = [[]]
+        length = baseLength
+        for value in sorted(set(values)):
+            valueLength = len(urllib.quote_plus(json.dumps(value) + ', '))
+
+            if chunks[-1] and length + valueLength > self.maxUrlLength:
+                chunks.append([])
+                length = baseLength
+
+            chunks[-1].append(value)
+            length += valueLength
+
+        return [{'filter': json.dumps({'where': {field: {'inq': chunk}}})} for chunk in chunks]
 
     def query(self, method, path, data = None, **params):
         """
@@ -72,23 +295,46 @@ class Mavis(object):
         if path[0] != '/': path = '/%s' % path
         url = ''.join(['http://', self.host, ':', self.port, path])
 
+        # concurrent identical reads - e.g. AsyncMavis workers - share a single request.
+        if method == 'get':
+            key = (path, json.dumps(params, sort_keys = True))
+            return self.__joinInFlight(key, self._send, method, url, data, params, contentType)
+
+        return self._send(method, url, data, params, contentType)
+
+    def _send(self, method, url, data, params, contentType):
+        """
+            Send a single request to Mavis, raising MavisError on failure.
+        """
+
+        # take a reference - concurrent responses replace, never mutate, the jar.
+        with self.__cookieLock: cookies = self.session
+
         # print url
         try:
-            resp = getattr(requests, method)(
+            resp = self.http.request(
+                method,
                 url,
                 data            = data,
                 params          = params,
                 allow_redirects = False,
-                cookies         = self.session,
-                headers         = {'content-type': contentType}
+                cookies         = cookies,
+                headers         = {'content-type': contentType},
+                timeout         = self.timeout
             )
+        except requests.exceptions.Timeout:
+            raise MavisError('Timed Out - Mavis did not respond within %s seconds.' % self.timeout)
         except requests.exceptions.ConnectionError:
             raise MavisError('Connection Refused - Mavis may be offline or unreachable.')
         except Exception as e:
             raise MavisError(500, e.args[0])
 
         if resp.cookies:
-            self.session = resp.cookies
+            with self.__cookieLock:
+                jar = RequestsCookieJar()
+                if self.session: jar.update(self.session)
+                jar.update(resp.cookies)
+                self.session = jar
 
         if resp.status_code > 399 and resp.status_code != 404:
             try: message = resp.json()['error']
@@ -97,6 +343,29 @@ class Mavis(object):
 
         return resp
 
+    def __joinInFlight(self, key, function, *args):
+        """
+            Call function(*args) unless a call for the same key is already running,
+            in which case wait for and share its result (or error).
+        """
+
+        with self.__inFlightLock:
+            call = self.__inFlight.get(key)
+            leader = call is None
+            if leader: call = self.__inFlight[key] = MavisFuture()
+
+        if not leader: return call.result()
+
+        try:
+            call._resolve(function(*args))
+        except:
+            call._resolve(error = sys.exc_info())
+        finally:
+            with self.__inFlightLock:
+                del self.__inFlight[key]
+
+        return call.result()
+
 class MavisError(Exception):
     """Pass through class to easily identify MavisErrors"""
 
@@ -108,6 +377,137 @@ class MavisError(Exception):
         self.errno = code
         Exception.__init__(self, message)
 
+class MavisFuture(object):
+    """
+        The pending result of a call made through a MavisPool (or AsyncMavis), or of
+        a GET that concurrent identical GETs are waiting on.
+
+        `result()` blocks until the call completes, then returns its value or
+        re-raises its exception (usually a MavisError).
+    """
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__value = None
+        self.__error = None
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self, timeout = None):
+        if not self.__done.wait(timeout):
+            raise MavisError('Timed Out - Mavis call did not complete within %s seconds.' % timeout)
+
+        if self.__error:
+            raise self.__error[0], self.__error[1], self.__error[2]
+
+        return self.__value
+
+    def _resolve(self, value = None, error = None):
+        self.__value = value
+        self.__error = error
+        self.__done.set()
+
+class MavisPool(object):
+    """
+        A bounded set of worker threads running Mavis calls concurrently.
+
+        No more than `size` calls are ever in flight; the rest wait in a queue.
+    """
+
+    def __init__(self, size = 16):
+        self.size = size
+        self.__tasks = Queue.Queue()
+        self.__workers = []
+        self.__lock = threading.Lock()
+
+    def submit(self, function, *args, **params):
+        """
+            Queue function(*args, **params), returning a MavisFuture for its result.
+        """
+
+        future = MavisFuture()
+        self.__tasks.put((future, function, args, params))
+
+        # workers are only started once there is work for them.
+        with self.__lock:
+            if len(self.__workers) < self.size:
+                worker = threading.Thread(target = self.__work)
+                worker.daemon = True
+                worker.start()
+                self.__workers.append(worker)
+
+        return future
+
+    def map(self, function, iterable):
+        """
+            Call function on every item concurrently, returning the results in order.
+        """
+        return gather(*[self.submit(function, item) for item in iterable])
+
+    def __work(self):
+        while True:
+            future, function, args, params = self.__tasks.get()
+            try:
+                future._resolve(function(*args, **params))
+            except:
+                future._resolve(error = sys.exc_info())
+
+def gather(*futures):
+    """
+        Wait for all given MavisFutures, returning their results in order.
+    """
+    return [future.result() for future in futures]
+
+class AsyncMavis(Mavis):
+    """
+        Non-blocking Mavis client with the same API as Mavis.
+
+        `get`, `post`, `put`, `delete`, `getEntity`, `getProject` and `entityForPath`
+        return a MavisFuture immediately - call `result()` (or pass several to `gather`)
+        to collect the response. At most `concurrency` requests are sent at once.
+        Errors, including the 404 pass-through, behave exactly as in Mavis.
+    """
+
+    def __init__(self, username, password, host = 'localhost', port = '3000', loginUrl = 'api/Users/login',
+                 concurrency = 16, timeout = 30):
+
+        # logging in is synchronous - every later call needs the session cookie.
+        super(AsyncMavis, self).__init__(username, password, host, port, loginUrl,
+                                         poolSize = concurrency, timeout = timeout)
+        self.pool = MavisPool(concurrency)
+
+    def get(self, path, **params):
+        """ READ """
+        return self.pool.submit(super(AsyncMavis, self).get, path, **params)
+
+    def post(self, path, data, **params):
+        """ CREATE """
+        return self.pool.submit(super(AsyncMavis, self).post, path, data, **params)
+
+    def put(self, path, data, **params):
+        """ UPDATE """
+        return self.pool.submit(super(AsyncMavis, self).put, path, data, **params)
+
+    def delete(self, path, **params):
+        """ DELETE """
+        return self.pool.submit(super(AsyncMavis, self).delete, path, **params)
+
+    def getEntity(self, entityId, prefetch = False, fields = None):
+        return self.pool.submit(super(AsyncMavis, self).getEntity, entityId, prefetch, fields)
+
+    def getProject(self, projectNameStr):
+        return self.pool.submit(super(AsyncMavis, self).getProject, projectNameStr)
+
+    def entityForPath(self, entityPath, prefetch = False, fields = None):
+        return self.pool.submit(super(AsyncMavis, self).entityForPath, entityPath, prefetch, fields)
+
+    def entitiesForPaths(self, entityPaths):
+        return self.pool.submit(super(AsyncMavis, self).entitiesForPaths, entityPaths)
+
+    def entitiesForIds(self, entityIds):
+        return self.pool.submit(super(AsyncMavis, self).entitiesForIds, entityIds)
+
 
 
 
@@ -128,16 +528,16 @@ def main():
 
     entityId = 21
 
-    # Step 1
-    data = conn.getEntity(entityId)
+    # Step 1 - the project comes back with the entity.
+    data = conn.getEntity(entityId, prefetch = True)
     if 'error' in data:
         print '\n404: NOT FOUND\t Entity#%s\n'%entityId; return
 
 
     print 'Entity#%s json:\n%s\n'%(data['id'], data)
 
-    # Step 2
-    project = conn.getProject(data['project'])
+    # Step 2 - only needed if the server lacks the project relation.
+    project = data.get(conn.projectRelation) or conn.getProject(data['project'])
     print 'Project for Entity#%s:\n%s\n'%(data['id'], project)
 
 
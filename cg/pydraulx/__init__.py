@@ -1 +1 @@
-from mavis import Mavis
+from mavis import Mavis, MavisCache, MavisValidators, MavisRetry, MavisCircuitBreaker, MavisStats, MavisCodec, MavisRateLimiter
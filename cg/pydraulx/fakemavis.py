@@ -0,0 +1,539 @@
+"""
+    A self-contained stand-in for the Mavis server, for benchmarking and testing HDX
+    tools offline.
+
+    It serves the routes the Mavis clients use - login, get/post/put/delete on HDX
+    (/projects/...) paths, the LoopBack /api/Entities collection (including findOne,
+    filters, includes and paging) and lucy job submission - from in-memory fixtures,
+    with configurable latency, error rate and payload size.
+
+    $ python fakemavis.py --port 3000 --latency 0.02 --error-rate 0.01
+    $ python fakemavis.py --bench 200 --payload-size 100000 --compress
+    $ python fakemavis.py --check
+"""
+
+import os
+import re
+import zlib
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urlparse
+import email.utils
+import SocketServer
+import BaseHTTPServer
+
+HOST = '127.0.0.1'
+PORT = 3000
+
+TEST_PROJECT = {"root":"/hdx","project":"andreas","templateType":"project","path":"/movie_projects/andreas","name":"andreas","projectLibrary":"1","fields":{"project_name":"andreas","project_root":"/tmp/movie_projects/andreas","status":"Bidding","project_resolution":"2k_Super35_24p","colorspace_settings":"AlexaV3LogC","aspect_ratio":"2.4","protection_ratio":"2.4"},"createdBy":"chris","createdAt":"2015-07-14T22:41:54.012Z","updatedAt":"2015-07-14T22:41:54.206Z","id":23,"type":"movie_projects","libraryIds":[1]}
+TEST_ENTITY = {"root":"/","project":"andreas","templateType":"asset","path":"/andreas/plates/rr_1680_plate","name":"rr_1680_plate","fields":{"inputStartFrame":110,"startFrame":1001,"endFrame":23002,"inputColorSpace":"Cineon","inputX":1080,"inputY":720,"head":10,"tail":23000},"createdBy":"trevor","createdAt":"2015-07-14T22:41:53.985Z","id":21,"type":"plates","libraryIds":[],"importFilepath":"import/andreas/plates/rr_1680/rr_1680_bg2.%04d.dpx","publishes":[{"root":"/hdx","version":0,"path":"/hdx/movie_projects/andreas/shots/is_010","source":"/hdx/movie_projects/andreas/shots/is_010","description":"Desc","project":"andreas","createdBy":"chris","createdAt":"2015-07-17T00:31:55.417Z","id":4,"entityId":21}]}
+TEST_HDX_PROJECT = {"id":30,"name":"test006","type":"projects","path":"/projects/test006","data":{"defaults":{"plates":{"colorspace":"Cineon"}}}}
+TEST_HDX_SHOT = {"id":31,"name":"tst001","type":"shots","project":"test006","parentId":30,"path":"/projects/test006/shots/tst001"}
+TEST_HDX_PLATE = {"id":32,"name":"client","type":"plates","project":"test006","parentId":31,"path":"/projects/test006/shots/tst001/plates/client","publishes":[],"links":[],"activity":[],"input":{"colorspace":"Cineon","inX":1920,"inY":1080}}
+
+FIXTURES = [TEST_PROJECT, TEST_ENTITY, TEST_HDX_PROJECT, TEST_HDX_SHOT, TEST_HDX_PLATE]
+"""Entities every FakeMavis starts with unless given its own."""
+
+class FakeMavis(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+        An in-memory Mavis server running on a background thread.
+
+        `latency` is the delay (seconds) added to every response - a (min, max) tuple
+        picks a random delay in that range. `errorRate` is the fraction of requests
+        answered with a 503, and `payloadSize` pads every returned entity with that
+        many bytes (of hex, so compression is realistic). With `compress`, responses
+        are gzipped for clients that accept it. Gzipped request bodies are always
+        accepted. Request and connection counts are kept in `requests` and
+        `connections`. `relations` are the relations entities define - including any
+        other is answered with a 500, as LoopBack does.
+
+        GETs carry an ETag and a Last-Modified - the time of the last write to any
+        entity, to the second - and are answered with a 304 when either validator
+        still holds (If-None-Match taking precedence, as in HTTP).
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host = HOST, port = 0, fixtures = None, latency = 0, errorRate = 0, payloadSize = 0,
+                 compress = False, relations = ('publishes', 'parent', 'projectEntity')):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeMavisHandler)
+
+        self.latency = latency
+        self.errorRate = errorRate
+        self.payloadSize = payloadSize
+        self.padding = os.urandom(payloadSize / 2 + 1).encode('hex')[:payloadSize]
+        self.compress = compress
+        self.relations = relations
+        self.requests = 0
+        self.connections = 0
+        self.jobs = []
+        self.entities = {}
+        self.modified = time.time()
+        self.lock = threading.Lock()
+
+        self.load(FIXTURES if fixtures is None else fixtures)
+
+    @property
+    def host(self):
+        return self.server_address[0]
+
+    @property
+    def port(self):
+        """The bound port, as the string Mavis expects."""
+        return str(self.server_address[1])
+
+    def load(self, entities):
+        """
+            Add fixture entities (dicts with at least an `id` and a `path`), or load
+            them from a JSON file when given a path.
+        """
+
+        if isinstance(entities, basestring):
+            with open(entities) as fixtureFile: entities = json.load(fixtureFile)
+
+        with self.lock:
+            for entity in entities:
+                self.entities[entity['id']] = json.loads(json.dumps(entity))
+            self.modified = time.time()
+
+    def start(self):
+        """
+            Serve on a daemon thread, returning self.
+        """
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def byPath(self, path):
+        for entity in self.entities.values():
+            if entity.get('path') == path: return entity
+        return None
+
+    def create(self, entity):
+        with self.lock:
+            entity['id'] = max(self.entities.keys() or [0]) + 1
+            self.entities[entity['id']] = entity
+        return entity
+
+class FakeMavisHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Request handler for FakeMavis - speaks HTTP/1.1 so keep-alive can be measured.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # send each response in one write - header-by-header writes stall keep-alive clients.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    __hdxPattern = re.compile('^(?:/hdx)?(/projects(?:/.*)?)$')
+    __entityPattern = re.compile('^/api/Entities/(\d+)$')
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock: self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self): self.__handle('get')
+    def do_POST(self): self.__handle('post')
+    def do_PUT(self): self.__handle('put')
+    def do_DELETE(self): self.__handle('delete')
+
+    def __handle(self, method):
+        server = self.server
+        with server.lock: server.requests += 1
+
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else None
+        if body and self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        latency = server.latency
+        if isinstance(latency, tuple): latency = random.uniform(*latency)
+        if latency: time.sleep(latency)
+
+        if server.errorRate and random.random() < server.errorRate:
+            return self.__respond(503, {'error': 'Service Unavailable'})
+
+        # LoopBack answers includes of undefined relations with a 500.
+        try:
+            self.__route(method, body)
+        except LookupError as e:
+            self.__respond(500, {'error': str(e)})
+
+        # after the write, so a GET racing it is never stamped newer than its body.
+        if method != 'get': server.modified = time.time()
+
+    def __route(self, method, body):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        path = url.path.rstrip('/') or '/'
+        query = urlparse.parse_qs(url.query)
+        data = None
+        if body:
+            try: data = json.loads(body)
+            except ValueError: data = body
+
+        if path.lower().endswith('/users/login'):
+            return self.__login(data)
+
+        if path == '/lucy':
+            with server.lock: server.jobs.append(data)
+            return self.__respond(200, {'id': len(server.jobs)})
+
+        if path == '/api/Entities/findOne':
+            entities = self.__find(self.__filter(query))
+            if not entities: return self.__respond(404, {'error': 'Not Found'})
+            return self.__respond(200, entities[0])
+
+        if path == '/api/Entities':
+            if method == 'post': return self.__respond(200, server.create(data))
+            return self.__respond(200, self.__find(self.__filter(query)))
+
+        matches = self.__entityPattern.match(path)
+        if matches:
+            return self.__entity(method, int(matches.group(1)), data, self.__filter(query))
+
+        matches = self.__hdxPattern.match(path)
+        if matches:
+            return self.__hdx(method, matches.group(1), data, query)
+
+        self.__respond(404, {'error': 'Not Found'})
+
+    def __login(self, data):
+        token = hashlib.sha1('%s%s' % (time.time(), random.random())).hexdigest()
+        self.__respond(200, {'id': token, 'userId': (data or {}).get('username')},
+                       {'Set-Cookie': 'mavis.sess=%s; Path=/' % token})
+
+    def __entity(self, method, entityId, data, entityFilter):
+        server = self.server
+        entity = server.entities.get(entityId)
+        if entity is None: return self.__respond(404, {'error': 'Not Found'})
+
+        if method == 'put':
+            with server.lock: entity.update(data or {})
+        elif method == 'delete':
+            with server.lock: del server.entities[entityId]
+            return self.__respond(200, {'count': 1})
+
+        self.__respond(200, self.__shape(entity, entityFilter))
+
+    def __hdx(self, method, path, data, query):
+        """
+            HDX paths return metadata indexed by type. `iterate` adds every component
+            entity along the path, `entity` and `name` address a virtual entity.
+        """
+
+        server = self.server
+        if 'entity' in query and 'name' in query:
+            path = '%s/%s/%s' % (path, query['entity'][0], query['name'][0])
+
+        entity = server.byPath(path)
+
+        if method == 'post':
+            if entity is not None: return self.__respond(409, {'error': 'Already Exists'})
+            components = path.strip('/').split('/')
+            entity = dict(data or {}, path = path, name = components[-1], type = components[-2])
+            return self.__respond(200, server.create(entity))
+
+        if entity is None: return self.__respond(404, {'error': 'Not Found'})
+
+        if method == 'put':
+            with server.lock: entity.update(data or {})
+            return self.__respond(200, entity)
+        if method == 'delete':
+            with server.lock: del server.entities[entity['id']]
+            return self.__respond(200, True)
+
+        metadata = {}
+        if query.get('iterate', ['false'])[0].lower() == 'true':
+            components = path.strip('/').split('/')
+            for i in xrange(2, len(components), 2):
+                component = server.byPath('/' + '/'.join(components[:i]))
+                if component is not None: metadata[component['type']] = self.__pad(component)
+
+        metadata[entity['type']] = self.__pad(entity)
+        self.__respond(200, metadata)
+
+    def __filter(self, query):
+        """
+            Read a LoopBack filter from either `filter=<json>` or `filter[a][b]=c` params.
+        """
+
+        if 'filter' in query: return json.loads(query['filter'][0])
+
+        entityFilter = {}
+        for key, values in query.items():
+            keys = re.findall('\[([^\]]*)\]', key)
+            if not key.startswith('filter[') or not keys: continue
+
+            node = entityFilter
+            for k in keys[:-1]: node = node.setdefault(k, {})
+            node[keys[-1]] = values[0] if len(values) == 1 else values
+
+        # bracketed limit/skip arrive as strings, `inq` lists as index-keyed dicts.
+        for k in ('limit', 'skip'):
+            if k in entityFilter: entityFilter[k] = int(entityFilter[k])
+        for condition in entityFilter.get('where', {}).values():
+            if isinstance(condition, dict) and isinstance(condition.get('inq'), dict):
+                condition['inq'] = [v for i, v in sorted(condition['inq'].items(), key = lambda i: int(i[0]))]
+
+        return entityFilter
+
+    def __find(self, entityFilter):
+        """
+            Apply a LoopBack filter (where/order/skip/limit/include/fields) to all entities.
+        """
+
+        where = entityFilter.get('where') or {}
+
+        def matches(entity):
+            for field, condition in where.items():
+                value = entity.get(field)
+                if isinstance(condition, dict) and 'inq' in condition:
+                    if value not in condition['inq'] and str(value) not in map(str, condition['inq']): return False
+                elif value != condition and str(value) != str(condition): return False
+            return True
+
+        entities = [e for e in self.server.entities.values() if matches(e)]
+
+        order = entityFilter.get('order', 'id ASC').split()
+        entities.sort(key = lambda e: e.get(order[0]), reverse = len(order) > 1 and order[1].upper() == 'DESC')
+
+        skip = int(entityFilter.get('skip') or 0)
+        entities = entities[skip:]
+        if entityFilter.get('limit'): entities = entities[:int(entityFilter['limit'])]
+
+        return [self.__shape(e, entityFilter) for e in entities]
+
+    def __shape(self, entity, entityFilter):
+        """
+            Resolve `include` relations and `fields` projection for one entity.
+        """
+
+        entity = dict(entity)
+        include = entityFilter.get('include') or []
+        if not isinstance(include, list): include = [include]
+
+        for relation in include:
+            nested = None
+            if isinstance(relation, dict): relation, nested = relation.items()[0]
+            if relation not in self.server.relations:
+                raise LookupError('Relation "%s" is not defined for Entity model' % relation)
+
+            related = self.__relation(entity, relation)
+            if isinstance(related, dict) and nested:
+                related = self.__shape(related, {'include': nested})
+            if related is not None: entity[relation] = related
+
+        fields = entityFilter.get('fields')
+        if isinstance(fields, dict): fields = [k for k, v in fields.items() if v and v != 'false']
+        if fields: entity = dict((k, v) for k, v in entity.items() if k in fields or k in include)
+
+        return self.__pad(entity)
+
+    def __relation(self, entity, relation):
+        entities = self.server.entities
+        if relation == 'publishes': return entity.get('publishes', [])
+        if relation == 'parent': return entities.get(entity.get('parentId'))
+        if relation == 'projectEntity':
+            for e in entities.values():
+                if e.get('name') == entity.get('project') and e.get('type') in ('projects', 'movie_projects'):
+                    return e
+        return None
+
+    def __pad(self, entity):
+        if not self.server.payloadSize: return entity
+        return dict(entity, padding = self.server.padding)
+
+    def __respond(self, status, body, headers = None):
+        """
+            Send JSON, honouring If-None-Match and If-Modified-Since with a bodiless 304.
+        """
+
+        payload = json.dumps(body)
+        etag = '"%s"' % hashlib.md5(payload).hexdigest()
+        modified = int(self.server.modified)
+        lastModified = email.utils.formatdate(modified, usegmt = True)
+
+        if status == 200 and self.command == 'GET' and self.__notModified(etag, modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', lastModified)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+
+        if self.server.compress and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 200:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', lastModified)
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __notModified(self, etag, modified):
+        if 'If-None-Match' in self.headers: return self.headers['If-None-Match'] == etag
+
+        since = email.utils.parsedate_tz(self.headers.get('If-Modified-Since') or '')
+        return since is not None and modified <= email.utils.mktime_tz(since)
+
+def bench(requests = 200, **options):
+    """
+        Time `requests` GETs through Mavis against a FakeMavis started with options,
+        once per client configuration. Returns (name, seconds, connections) rows.
+    """
+
+    from mavis import Mavis, MavisCache, MavisValidators, MavisCodec
+
+    configurations = [
+        ('plain', {}),
+        ('stdlib json', {'codec': MavisCodec(json)}),
+        ('cache', {'cache': MavisCache(size = requests)}),
+        ('validators', {'validators': MavisValidators(size = requests)}),
+    ]
+
+    results = []
+    for name, clientOptions in configurations:
+        server = FakeMavis(**options).start()
+        try:
+            conn = Mavis('bench', 'password', server.host, server.port, **clientOptions)
+            started = time.time()
+            for i in xrange(requests):
+                conn.get('/projects/test006/shots/tst001/plates/client', iterate = True)
+            results.append((name, time.time() - started, server.connections))
+            conn.close()
+        finally:
+            server.stop()
+
+    return results
+
+def check():
+    """
+        Assert client behaviour that should cost no (or fewer) requests, against a
+        FakeMavis. Raises AssertionError naming the first check that fails.
+    """
+
+    import hdxutils
+    import requests
+    from mavis import Mavis, MavisValidators
+    from hdxindex import HDXIndex
+    from hdxentities import HDXShot
+
+    # fixture paths are not on this filesystem - report every path as existing.
+    class HDXEverywhere(hdxutils.HDXStatCache):
+        def stat(self, path, forceCheck = False):
+            return os.stat(os.curdir)
+
+    statCache, pathParser = hdxutils.statCache, hdxutils.pathParser
+    hdxutils.statCache = HDXEverywhere()
+
+    server = FakeMavis().start()
+    try:
+        conn = Mavis('check', 'password', server.host, server.port)
+
+        # paths decoded from Mavis JSON are unicode, equal to the str fixture paths - a
+        # fresh parser, so an earlier parse of the str path cannot hide a failure.
+        hdxutils.pathParser = hdxutils.HDXPathParser()
+
+        # an entity whose metadata is indexed (from a real response) never asks Mavis for it.
+        index = HDXIndex()
+        index.addEntities(conn.entitiesForPaths([TEST_HDX_PROJECT['path'], TEST_HDX_SHOT['path']]).values())
+        assert len(index) == 2, 'indexed %d entities' % len(index)
+        before = server.requests
+        shot = HDXShot(os.path.join(os.path.sep, 'hdx') + TEST_HDX_SHOT['path'], conn, index = index)
+        assert shot.getMetadata('id') == TEST_HDX_SHOT['id'], 'indexed metadata'
+        assert server.requests == before, 'indexed construction made %d requests' % (server.requests - before)
+
+        # a unicode path parses like its str equal - again with a fresh parser.
+        hdxutils.pathParser = hdxutils.HDXPathParser()
+        shotPath = os.path.join(os.path.sep, 'hdx') + conn.get(TEST_HDX_SHOT['path'])['shots']['path']
+        assert isinstance(shotPath, unicode), 'Mavis paths decode as unicode'
+        parsed = hdxutils.parsePath(shotPath)
+        assert (parsed.type, parsed.name) == ('shots', TEST_HDX_SHOT['name']), 'unicode path parsed'
+
+        # as a move or copy does with the path Mavis returns.
+        shot.path = shotPath
+        shot._parsePath()
+        assert shot.name == TEST_HDX_SHOT['name'], 'entity re-parsed from a unicode path'
+        conn.close()
+
+        # a repeated GET is revalidated with a 304 and served from the stored body.
+        conn = Mavis('check', 'password', server.host, server.port, validators = MavisValidators())
+        plate = TEST_HDX_PLATE['path']
+        first = conn.get(plate)
+        before = server.requests
+        assert conn.get(plate) == first, 'revalidated body'
+        assert server.requests == before + 1, 'revalidation made %d requests' % (server.requests - before)
+        assert conn.validators.revalidated == 1, 'revalidation was not answered with a 304'
+        conn.close()
+
+        # Last-Modified alone revalidates too, until something is written.
+        url = 'http://%s:%s%s' % (server.host, server.port, plate)
+        lastModified = requests.get(url).headers['last-modified']
+        resp = requests.get(url, headers = {'If-Modified-Since': lastModified})
+        assert resp.status_code == 304, 'If-Modified-Since answered with %d' % resp.status_code
+
+        time.sleep(1)
+        requests.put(url, json = {'status': 'final'})
+        resp = requests.get(url, headers = {'If-Modified-Since': lastModified})
+        assert resp.status_code == 200, 'If-Modified-Since after a write answered with %d' % resp.status_code
+    finally:
+        server.stop()
+        hdxutils.statCache, hdxutils.pathParser = statCache, pathParser
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Serve (or benchmark against) a fake Mavis.')
+    parser.add_argument('--host', default = HOST)
+    parser.add_argument('--port', type = int, default = PORT)
+    parser.add_argument('--fixtures', help = 'JSON file containing a list of entities')
+    parser.add_argument('--latency', type = float, default = 0, help = 'seconds added to every response')
+    parser.add_argument('--error-rate', type = float, default = 0, help = 'fraction of requests answered with 503')
+    parser.add_argument('--payload-size', type = int, default = 0, help = 'bytes of padding per entity')
+    parser.add_argument('--compress', action = 'store_true', help = 'gzip responses for clients that accept it')
+    parser.add_argument('--bench', type = int, metavar = 'REQUESTS', help = 'run the client benchmark and exit')
+    parser.add_argument('--check', action = 'store_true', help = 'run the client checks and exit')
+    args = parser.parse_args()
+
+    options = {'latency': args.latency, 'errorRate': args.error_rate, 'payloadSize': args.payload_size,
+               'compress': args.compress}
+
+    if args.check:
+        check()
+        print 'all checks passed'
+        return
+
+    if args.bench:
+        for name, seconds, connections in bench(args.bench, **options):
+            print '%-12s %8.3fs %8.0f req/s %4d connections' % (name, seconds, args.bench / seconds, connections)
+        return
+
+    server = FakeMavis(args.host, args.port, **options)
+    if args.fixtures: server.load(args.fixtures)
+
+    print 'Fake Mavis listening on http://%s:%s' % (server.host, server.port)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
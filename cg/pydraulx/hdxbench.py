@@ -0,0 +1,163 @@
+"""
+    Benchmarks for the HDX classes - run offline, against generated paths and
+    directory trees.
+
+    $ python hdxbench.py paths --count 100000
+    $ python hdxbench.py parser --count 10000 --passes 10
+    $ python hdxbench.py stats --ttl 2
+    $ python hdxbench.py sequences --frames 100000 --sequences 40
+"""
+
+import os
+import gc
+import time
+import shutil
+import tempfile
+import argparse
+
+from hdxutils import HDXPath, HDXPathParser, HDXStatCache
+from hdxmedia import HDXSequenceList, scanSequences
+
+def memory():
+    """
+        Resident memory of this process in bytes - from /proc where available, otherwise
+        the peak resident size (which only grows, so measure growth, not shrinkage).
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def benchPaths(count = 100000):
+    """
+        Build `count` HDXPaths from distinct plate paths, returning (seconds, bytesPerInstance).
+    """
+
+    sources = ['/mnt/x3/projects/p%02d/shots/s%05d/plates/bg%d' % (i % 20, i, i % 3) for i in xrange(count)]
+
+    gc.collect()
+    before = memory()
+    started = time.time()
+    paths = [HDXPath(source) for source in sources]
+    seconds = time.time() - started
+    gc.collect()
+
+    return seconds, (memory() - before) / float(len(paths))
+
+def benchParser(count = 10000, passes = 10):
+    """
+        Parse `count` distinct paths `passes` times - as a walker revisiting a tree does -
+        with a memoizing HDXPathParser and with one that caches nothing, returning
+        (memoizedSeconds, unmemoizedSeconds).
+    """
+
+    sources = ['/mnt/x3/projects/p%02d/shots/s%05d/plates/bg%d' % (i % 20, i, i % 3) for i in xrange(count)]
+
+    def run(parser):
+        started = time.time()
+        for i in xrange(passes):
+            for source in sources: parser.parse(source)
+        return time.time() - started
+
+    return run(HDXPathParser(size = count)), run(HDXPathParser(size = 0))
+
+def benchStats(ttl = 2, shots = 20, attributes = 20, versions = 12, passes = 2):
+    """
+        Walk a generated tree of shots x attributes x versions `passes` times, checking
+        each version and its shot and attribute exist through an HDXStatCache with `ttl`,
+        returning (seconds, statCalls).
+    """
+
+    root = tempfile.mkdtemp(prefix = 'hdxbench')
+    try:
+        checks = []
+        for shot in xrange(shots):
+            for attribute in xrange(attributes):
+                for version in xrange(versions):
+                    shotPath = os.path.join(root, 'shots', 's%03d' % shot)
+                    attributePath = os.path.join(shotPath, 'plates', 'a%03d' % attribute)
+                    versionPath = os.path.join(attributePath, 'versions', 'v%03d' % version)
+                    os.makedirs(versionPath)
+                    checks.append((versionPath, shotPath, attributePath))
+
+        cache = HDXStatCache(ttl = ttl)
+        started = time.time()
+        for i in xrange(passes):
+            for paths in checks:
+                for path in paths: cache.exists(path)
+
+        # every miss is one os.stat.
+        return time.time() - started, cache.misses
+    finally:
+        shutil.rmtree(root)
+
+def benchSequences(frames = 100000, sequences = 40, repeat = 7):
+    """
+        Group a generated directory of `frames` empty frames across `sequences` image
+        sequences, returning the best of `repeat` (listSeconds, scanSeconds, sequenceListSeconds)
+        - os.listdir alone, scanSequences, and HDXSequenceList(directory).
+    """
+
+    root = tempfile.mkdtemp(prefix = 'hdxbench')
+    try:
+        perSequence = frames // sequences
+        for sequence in xrange(sequences):
+            for frame in xrange(1001, 1001 + perSequence):
+                open(os.path.join(root, 'plate%02d_bg.%04d.exr' % (sequence, frame)), 'w').close()
+
+        def best(function):
+            times = []
+            for i in xrange(repeat):
+                started = time.time()
+                function(root)
+                times.append(time.time() - started)
+            return min(times)
+
+        return best(os.listdir), best(scanSequences), best(HDXSequenceList)
+    finally:
+        shutil.rmtree(root)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the HDX classes.')
+    commands = parser.add_subparsers(dest = 'command')
+
+    paths = commands.add_parser('paths', help = 'HDXPath construction time and memory per instance')
+    paths.add_argument('--count', type = int, default = 100000)
+
+    parse = commands.add_parser('parser', help = 'HDXPathParser throughput, memoized and not')
+    parse.add_argument('--count', type = int, default = 10000)
+    parse.add_argument('--passes', type = int, default = 10)
+
+    stats = commands.add_parser('stats', help = 'os.stat calls made walking a tree through an HDXStatCache')
+    stats.add_argument('--ttl', type = float, default = 2, help = 'cache ttl in seconds - 0 disables it')
+
+    sequenceList = commands.add_parser('sequences', help = 'grouping a directory of frames into sequences')
+    sequenceList.add_argument('--frames', type = int, default = 100000)
+    sequenceList.add_argument('--sequences', type = int, default = 40)
+
+    args = parser.parse_args()
+
+    if args.command == 'paths':
+        seconds, size = benchPaths(args.count)
+        print '%d HDXPaths in %.3fs, %.0f bytes per instance' % (args.count, seconds, size)
+
+    elif args.command == 'parser':
+        memoized, unmemoized = benchParser(args.count, args.passes)
+        parses = args.count * args.passes
+        print '%d parses: memoized %.3fs, unmemoized %.3fs, %.1fx faster' % (
+            parses, memoized, unmemoized, unmemoized / memoized)
+
+    elif args.command == 'stats':
+        seconds, calls = benchStats(args.ttl)
+        print 'walk with ttl %g: %d stat calls in %.3fs' % (args.ttl, calls, seconds)
+
+    elif args.command == 'sequences':
+        listing, scan, sequences = benchSequences(args.frames, args.sequences)
+        print '%d frames in %d sequences, best of 7: listdir %.3fs, scanSequences %.3fs, HDXSequenceList %.3fs' % (
+            args.frames, args.sequences, listing, scan, sequences)
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,17 @@
 """
 
 import os
+import errno
+import shutil
+import tempfile
 from datetime import date
+from collections import MutableMapping
 
-from hdxutils import HDXPath, HDXBaseEntity, HDXBaseVirtualEntity, HDXError
+from hdxutils import HDXPath, HDXBaseEntity, HDXBaseVirtualEntity, HDXBatch, HDXIdentityMap, HDXError, prefetch, statCache
 from hdxmedia import HDXSequence, HDXImage, HDXMovie
+from hdxindex import HDXIndex
+from hdxtransfer import HDXTransfer
+from hdxstore import HDXFrameStore
 
 ##-------------------------------
 ##  PHYSICAL DIRECTORY ENTITIES
@@ -24,6 +31,8 @@ class HDXProject(HDXBaseEntity):
 
     type = 'projects'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXProject, self).__init__(*args, **kwargs)
 
@@ -45,6 +54,8 @@ class HDXShot(HDXBaseEntity):
 
     type = 'shots'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXShot, self).__init__(*args, **kwargs)
 
@@ -55,6 +66,8 @@ class HDXAsset(HDXBaseEntity):
 
     type = 'assets'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXAsset, self).__init__(*args, **kwargs)
 
@@ -65,6 +78,8 @@ class HDXOffline(HDXBaseEntity):
 
     type = 'offlines'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXOffline, self).__init__(*args, **kwargs)
 
@@ -75,6 +90,8 @@ class HDXReference(HDXBaseEntity):
 
     type = 'references'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXReference, self).__init__(*args, **kwargs)
 
@@ -86,49 +103,126 @@ class HDXAttribute(HDXBaseEntity):
 
     type = 'attributes'
 
-    versions = {}
+    __slots__ = ('versions',)
 
     def __init__(self, *args, **kwargs):
+        self.versions = HDXVersions(self)
         super(HDXAttribute, self).__init__(*args, **kwargs)
 
-        if self.exists():
-            self.__loadVersions()
+    def loadAll(self):
+        """
+            Alias for HDXVersions.loadAll
+        """
+        return self.versions.loadAll()
 
-    def publish(self, source, metadata = {}, fileName = None, copySource = False, publishType = 'MASTER'):
+    def publish(self, source, metadata = {}, fileName = None, copySource = False, publishType = 'MASTER', transfer = None):
         """
             Create a new HDXAttributeVersion of given publishType, optionally copying the source file into the new directory.
+
+            Copies are made client side by `transfer` (an HDXTransfer - linking where possible) when given.
         """
 
         # the metadata field 'versions' is the current max version number - increment it.
         v = (self.getMetadata('versions') or 0) + 1
-        self.versions[v] = HDXAttributeVersion(self, str(v))
-        self.versions[v].fileName = fileName
+        version = HDXAttributeVersion(self, str(v))
+        version.fileName = fileName
 
         # add source and publishType to metadata and create.
         metadata.update({'source':source,'publishType':publishType})
-        self.versions[v].make(metadata, copySource = copySource)
+        try:
+            version.make(metadata, copySource = copySource, transfer = transfer)
+        finally:
+            # manually update in-memory metadata. somewhat fragile. Once Mavis has the
+            # version its number is taken, even if the publish then failed - otherwise
+            # the next publish would collide with it.
+            if version.type in (version._metadata or {}):
+                self.versions[v] = version
+                self.metadata['attributes']['versions'] = v
+                if publishType == 'MASTER':
+                    self.metadata['attributes']['masterVersion'] = v
+                    self.versions['MASTER'] = version
+
+        return version
+
+class HDXVersions(MutableMapping):
+    """
+        The HDXAttributeVersions of an HDXAttribute, indexed by number and 'MASTER'.
 
-        # manually update in-memory metadata. somewhat fragile.
-        self.metadata['attributes']['versions'] = v
-        if publishType == 'MASTER':
-            self.metadata['attributes']['masterVersion'] = v
-            self.versions['MASTER'] = self.versions[v]
+        Keys come from the attribute's `versions` count - each HDXAttributeVersion is
+        only created (and checked for on the filesystem) when first accessed, and
+        'MASTER' resolves to the master version alone. loadAll creates them all at once.
+    """
 
-        return self.versions[v]
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.__versions = {}
 
-    def __loadVersions(self):
+    def loadAll(self):
         """
-            Retrieve all HDXAttributeVersion children of this (existing) HDXAttribute
+            Create every version, fetching their metadata in bulk (see prefetch) and
+            checking them against a single listing of the versions directory.
         """
 
-        versions = [v+1 for v in range(self.getMetadata('versions'))]
-        for v in versions:
-            self.versions[v] = HDXAttributeVersion(self, str(v))
+        missing = [v for v in self.__numbers() if v not in self.__versions]
+        if not missing: return self
+
+        try:
+            published = set(os.listdir(os.path.join(self.attribute.path, HDXAttributeVersion.type)))
+        except OSError:
+            published = set()
+
+        versions = []
+        for v in missing:
+            if str(v) not in published: self.__missing(v)
+            versions.append(HDXAttributeVersion(self.attribute, str(v)))
+
+        prefetch(versions)
+        for version in versions:
+            self.__versions[int(version)] = version
+
+        return self
+
+    def __numbers(self):
+        return range(1, (self.attribute.getMetadata('versions', self.attribute.type) or 0) + 1)
+
+    def __missing(self, v):
+        raise HDXError('%s version %d exists in Mavis, but not on the filesystem. Seek help.' % (self.attribute.__name__, v))
+
+    def __getitem__(self, key):
+        if key in self.__versions: return self.__versions[key]
 
-            if not self.versions[v].exists():
-                raise HDXError('%s version %d exists in Mavis, but not on the filesystem. Seek help.' % (self.__name__, v))
+        if key == 'MASTER':
+            master = self.attribute.getMetadata('masterVersion', self.attribute.type)
+            if master is None: raise KeyError(key)
+            return self[master]
 
-        self.versions['MASTER'] = self.versions[self.getMetadata('masterVersion')]
+        if key not in self.__numbers(): raise KeyError(key)
+
+        version = HDXAttributeVersion(self.attribute, str(key))
+        if not version.exists(): self.__missing(key)
+
+        self.__versions[key] = version
+        return version
+
+    def __contains__(self, key):
+        if key == 'MASTER': return key in self.__versions or self.attribute.getMetadata('masterVersion', self.attribute.type) is not None
+        return key in self.__versions or key in self.__numbers()
+
+    def __setitem__(self, key, version):
+        self.__versions[key] = version
+
+    def __delitem__(self, key):
+        del self.__versions[key]
+
+    def __iter__(self):
+        for v in self.__numbers(): yield v
+        if self.attribute.getMetadata('masterVersion', self.attribute.type) is not None: yield 'MASTER'
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return '<HDXVersions %s>' % list(self)
 
 ##--------------------------
 ##  PHYSICAL FILE ENTITIES
@@ -143,19 +237,58 @@ class HDXAttributeVersion(HDXBaseEntity):
 
     type = 'versions'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXAttributeVersion, self).__init__(*args, **kwargs)
     
     def make(self, metadata = None, **params):
-        """ Extend basic make behavior to add the fileName when copying the source. """
+        """
+            Extend basic make behavior to add the fileName when copying the source.
+
+            With `transfer` (an HDXTransfer) the source is copied client side rather than
+            by Mavis, and any checksums it computes are stored under `checksums`. The
+            files are transferred beside the version first and only moved in once Mavis
+            has made it - a failed transfer leaves neither files nor a version behind.
+        """
+
+        transfer = params.pop('transfer', None)
 
         if (metadata and
-            metadata.source and
-            params.copySource == True and
+            metadata.get('source') and
+            params.get('copySource') == True and
             self.fileName is None):
-            self.fileName = os.path.basename(metadata.source)
-
-        super(HDXAttributeVersion, self).make(metadata, **params)
+            self.fileName = os.path.basename(metadata['source'])
+
+        if transfer is None or not params.get('copySource'):
+            return super(HDXAttributeVersion, self).make(metadata, **params)
+
+        params['copySource'] = False
+
+        # a hidden staging directory on the same filesystem, so moving in is a rename.
+        versions = os.path.dirname(self.path)
+        try:
+            os.makedirs(versions)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+        staging = tempfile.mkdtemp(prefix = '.%s.' % self.name, dir = versions)
+
+        try:
+            results = transfer.transfer(metadata['source'], staging)
+            super(HDXAttributeVersion, self).make(metadata, **params)
+
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+            for name in os.listdir(staging):
+                os.rename(os.path.join(staging, name), os.path.join(self.path, name))
+        finally:
+            shutil.rmtree(staging, ignore_errors = True)
+            statCache.invalidate(versions)
+
+        if transfer.checksum:
+            self.update({'checksums': dict((os.path.relpath(path, staging), digest) for path, (mode, digest) in results.items())})
 
     def __int__(self):
         return int(self.name)
@@ -167,6 +300,8 @@ class HDXDaily(HDXBaseEntity):
 
     type = 'dialies'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXDaily, self).__init__(*args, **kwargs)
 
@@ -194,6 +329,8 @@ class HDXTask(HDXBaseVirtualEntity):
 
     type = 'tasks'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXTask, self).__init__(*args, **kwargs)
 
@@ -204,5 +341,7 @@ class HDXNote(HDXBaseVirtualEntity):
 
     type = 'notes'
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXNote, self).__init__(*args, **kwargs)
@@ -0,0 +1,157 @@
+"""
+    An in-memory index of the HDX hierarchy - projects, shots, assets, attributes,
+    versions, etc. - built from one filesystem walk or one bulk Mavis query.
+"""
+
+import os
+
+from hdxutils import parsePath, internName
+
+class HDXIndexNode(object):
+    """
+        A single entity in an HDXIndex - children are indexed by (type, name) pair.
+    """
+
+    __slots__ = ('type', 'name', 'path', 'parent', 'children', 'metadata', '__weakref__')
+
+    def __init__(self, type, name, path, parent = None):
+        self.type = type
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.children = {}
+        self.metadata = None
+
+    def __iter__(self):
+        return self.children.itervalues()
+
+    def __repr__(self):
+        return '<HDXIndexNode %s>' % self.path
+
+class HDXIndex(object):
+    """
+        Trie over the (type, name) component pairs produced by HDXPathParser.
+
+        Lookups cost one step per path component, and any subtree can be enumerated
+        (optionally filtered by type) without touching NFS or Mavis. Entities built
+        with `index = ...` take their metadata from the index instead of Mavis.
+    """
+
+    def __init__(self):
+        self.root = HDXIndexNode(None, None, os.path.join(os.path.sep, 'hdx'))
+        self.__size = 0
+
+    def add(self, path, metadata = None):
+        """
+            Add path (and any missing parents), returning its node. Metadata, if
+            given, replaces the node's metadata.
+        """
+
+        node = self.root
+        for type, name in parsePath(path).components:
+            node = self.__child(node, type, name)
+
+        if metadata is not None: node.metadata = metadata
+        return node
+
+    def addEntities(self, entities):
+        """
+            Index Mavis entities (dicts with a `path`) - e.g. the result of one bulk query.
+        """
+
+        for entity in entities:
+            self.add(entity['path'], entity)
+
+    def scan(self, root, path = None, depth = None):
+        """
+            Index the directory tree under root (e.g. a project directory) in one walk,
+            as HDX path `path` - by default root itself, which must then be an HDX path.
+
+            HDX directories alternate type and name, so only every second level becomes
+            a node. Hidden directories are skipped, as are levels below `depth` pairs.
+        """
+
+        def walk(directory, node, level):
+            if depth is not None and level >= depth: return
+
+            for type in self.__directories(directory):
+                typeDirectory = os.path.join(directory, type)
+                for name in self.__directories(typeDirectory):
+                    walk(os.path.join(typeDirectory, name), self.__child(node, type, name), level + 1)
+
+        node = self.add(path or root)
+        walk(root, node, 0)
+        return node
+
+    def node(self, path):
+        """
+            The node for path, or None if it is not indexed.
+        """
+
+        node = self.root
+        for pair in parsePath(path).components:
+            node = node.children.get(pair)
+            if node is None: return None
+
+        return node
+
+    def metadata(self, path):
+        """
+            Metadata for path and its components indexed by type (as HDXBaseEntity.metadata),
+            or None unless path itself has metadata.
+        """
+
+        node = self.node(path)
+        if node is None or node.metadata is None: return None
+
+        metadata = {}
+        while node is not self.root:
+            if node.metadata is not None: metadata[node.type] = node.metadata
+            node = node.parent
+
+        return metadata
+
+    def iterate(self, path = None, type = None):
+        """
+            Yield every node under path (depth first), optionally only those of type.
+        """
+
+        start = self.node(path) if path else self.root
+        if start is None: return
+
+        stack = list(start.children.values())
+        while stack:
+            node = stack.pop()
+            if type is None or node.type == type: yield node
+            stack.extend(node.children.values())
+
+    def children(self, path = None, type = None):
+        """
+            The direct children of path, optionally only those of type.
+        """
+
+        node = self.node(path) if path else self.root
+        if node is None: return []
+        return [child for child in node if type is None or child.type == type]
+
+    def __contains__(self, path):
+        return self.node(path) is not None
+
+    def __len__(self):
+        return self.__size
+
+    def __child(self, node, type, name):
+        pair = (internName(type), internName(name))
+        child = node.children.get(pair)
+        if child is None:
+            child = node.children[pair] = HDXIndexNode(pair[0], pair[1], os.path.join(node.path, *pair), node)
+            self.__size += 1
+        return child
+
+    def __directories(self, path):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return []
+
+        return [name for name in names if not name.startswith('.') and os.path.isdir(os.path.join(path, name))]
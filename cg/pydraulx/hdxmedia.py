@@ -5,8 +5,14 @@
 import re
 import os
 from glob import glob
+from collections import namedtuple
 
-from hdxutils import HDXBaseMedia, HDXError
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+from hdxutils import HDXBaseMedia, HDXError, statCache
 
 ##-------------
 ##  Sequences
@@ -14,27 +20,74 @@ from hdxutils import HDXBaseMedia, HDXError
 
 sequencePattern = re.compile('(\d+|%\d{2}d)\.(\w{1,4})$')
 
-class HDXSequence(HDXBaseMedia):
+class HDXSequenceGroup(namedtuple('HDXSequenceGroup', 'prefix padding extension frames')):
     """
-        A single image sequence.
+        Files of one image sequence found by scanSequences - the name before the frame
+        number, the frame number's width, the extension, and the set of frame numbers.
+    """
+
+    __slots__ = ()
+
+    @property
+    def fileName(self):
+        """The sequence's file name in sprintf notation."""
+        return '%s%%0%dd.%s' % (self.prefix, self.padding, self.extension)
+
+def scanSequences(directory):
     """
+        Group the files in directory into HDXSequenceGroups in a single pass.
+
+        Uses os.scandir where the interpreter has it (skipping sub-directories without a
+        stat), os.listdir otherwise.
+    """
+
+    if scandir is not None:
+        return groupSequences(entry.name for entry in scandir(directory) if not entry.is_dir())
+    return groupSequences(os.listdir(directory))
+
+def groupSequences(names):
+    """
+        Group file names into HDXSequenceGroups. Names without a frame number are ignored.
+    """
+
+    # split names with string methods rather than sequencePattern - the same split, at a
+    # fraction of the cost over 100k frames.
+    groups = {}
+    for name in names:
+        base, dot, extension = name.rpartition('.')
+        prefix = base.rstrip('0123456789')
+        frame = base[len(prefix):]
+        if not frame or not 0 < len(extension) < 5 or not extension.replace('_', 'a').isalnum(): continue
 
-    start = None
-    end = None
-    """ Defines the frame range of the sequence. """
+        key = (prefix, len(frame), extension)
 
-    renderStart = None
-    renderEnd = None
-    """ Optionally limit the frame range to render. """
+        frames = groups.get(key)
+        if frames is None: frames = groups[key] = []
+        frames.append(int(frame))
 
-    totalFrames = 0
+    return [HDXSequenceGroup(prefix, padding, extension, frozenset(frames))
+            for (prefix, padding, extension), frames in groups.iteritems()]
 
-    shotName = None
-    """ Possible shot name parsed from sequence name. """
+class HDXSequence(HDXBaseMedia):
+    """
+        A single image sequence.
+
+        start, end              - the frame range of the sequence.
+        renderStart, renderEnd  - optionally limit the frame range to render.
+        totalFrames             - number of frames from start to end.
+        shotName                - possible shot name parsed from sequence name.
+    """
+
+    __slots__ = ('start', 'end', 'renderStart', 'renderEnd', 'totalFrames', 'shotName')
 
     __shotNamePattern = re.compile('^([^_\W]+)_?(?:plt\d+?|plate\d+?|bg\d+?|fg\d+?)?([^_\W]+)?')
 
     def __init__(self, *args, **kwargs):
+        self.start = self.end = None
+        self.renderStart = self.renderEnd = None
+        self.totalFrames = 0
+        self.shotName = None
+
         super(HDXSequence, self).__init__(*args, **kwargs)
 
         # replace individual file name with sprintf notation.
@@ -171,13 +224,13 @@ class HDXSequence(HDXBaseMedia):
                 strip,
                 os.path.join(componentMavisDirectory, os.path.basename(strip)))
 
-    def exists(self, component = None):
+    def exists(self, component = None, forceCheck = False):
         """ Overwrite `exists` to account for sprintf notation. """
 
         if not component:
-            return os.path.exists(self.path % self.start)
+            return statCache.exists(self.path % self.start, forceCheck)
         else:
-            return os.path.exists(self.getPath(component))
+            return statCache.exists(self.getPath(component), forceCheck)
 
     def _importNuke(self):
         try:
@@ -194,35 +247,27 @@ class HDXSequenceList(HDXBaseMedia):
         a directory containing multiple sequences.
     """
 
-    list = []
-    """ Contains the list of HDXSequences found in the given path """
+    __slots__ = ('list',)
 
     def __init__(self, *args, **kwargs):
+        # the list of HDXSequences found in the given path.
+        self.list = []
+
         super(HDXSequenceList, self).__init__(*args, **kwargs)
 
         if os.path.isfile(self.path):
             self.list = [HDXSequence(self)]
             return
-        elif os.path.isdir(self.path): files = os.listdir(self.path)
-        else: 
-            files = [os.path.basename(f) for f in glob(sequencePattern.sub(r'*.\2', self.path))]
+        elif os.path.isdir(self.path): groups = scanSequences(self.path)
+        else:
+            # glob's filtering beats grouping a whole directory for one sequence's files.
+            groups = groupSequences(os.path.basename(f) for f in glob(sequencePattern.sub(r'*.\2', self.path)))
             self.path = os.path.dirname(self.path)
 
-        # group files into sequences with start and end frame numbers.
-        sequences = {}
-        for file in files:
-            matches = sequencePattern.search(file)
-            frame = matches.group(1)
-            intFrame = int(frame)
-            sequence = file.replace(frame, '%%0%dd' % len(frame))
-
-            if sequence not in sequences: sequences[sequence] = [intFrame, intFrame]
-            else:
-                sequences[sequence][0] = min(sequences[sequence][0], intFrame)
-                sequences[sequence][1] = max(sequences[sequence][1], intFrame)
-
-        for basename, frames in sequences.iteritems():
-            self.list.append(HDXSequence(os.path.join(self.path, basename), self.mavis, start=frames[0], end=frames[1]))
+        # the scan already knows each frame range - HDXSequence need not scan again.
+        for group in groups:
+            self.list.append(HDXSequence(os.path.join(self.path, group.fileName), self.mavis,
+                                         start=min(group.frames), end=max(group.frames)))
 
     def __iter__(self):
         for sequence in self.list:
@@ -239,6 +284,8 @@ class HDXImage(HDXBaseMedia):
         A single still image.
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXImage, self).__init__(*args, **kwargs)
 
@@ -247,5 +294,7 @@ class HDXMovie(HDXBaseMedia):
         A single movie file (usually quicktime).
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(HDXMovie, self).__init__(*args, **kwargs)
@@ -0,0 +1,156 @@
+"""
+    A content-addressed store of published frames, so frames that are byte-identical to
+    an earlier publish are hardlinked to it rather than stored again.
+
+    $ python hdxstore.py report /mnt/x3/.hdxstore
+    $ python hdxstore.py verify /mnt/x3/.hdxstore
+"""
+
+import os
+import sys
+import errno
+import hashlib
+import argparse
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+class HDXFrameStore(object):
+    """
+        Blobs named by a fast hash of their content (xxhash when installed, otherwise
+        md5) and their size, under root/<first two characters>/.
+
+        Pass a store to HDXTransfer - each frame whose blob exists is hardlinked to it,
+        and each new frame is linked into the store once transferred. Hardlinks cannot
+        cross filesystems, so root must be on the same filer as the publishes it serves.
+        `files`, `linked` and `bytesSaved` count this session's work - see report and
+        usage.
+    """
+
+    chunkSize = 8 * 1024 * 1024
+    """Read size when hashing."""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = 0
+        self.linked = 0
+        self.bytesSaved = 0
+        self.__lock = threading.Lock()
+
+    def key(self, path):
+        """
+            The blob name for path's content.
+        """
+
+        digest = xxhash.xxh64() if xxhash else hashlib.md5()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunkSize), ''):
+                digest.update(chunk)
+                size += len(chunk)
+
+        return '%s-%d' % (digest.hexdigest(), size)
+
+    def blob(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def link(self, key, target):
+        """
+            Hardlink target to the blob for key, returning False if there is no usable
+            blob - none yet, another filesystem, or one already at the filesystem's link
+            limit (e.g. 65000 on ext4, soon reached by black or slate frames).
+        """
+
+        try:
+            os.link(self.blob(key), target)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.EXDEV, errno.EMLINK): return False
+            raise
+
+        with self.__lock:
+            self.files += 1
+            self.linked += 1
+            self.bytesSaved += os.path.getsize(target)
+        return True
+
+    def add(self, key, path):
+        """
+            Link path into the store as the blob for key (unless it already exists).
+        """
+
+        with self.__lock: self.files += 1
+
+        blob = self.blob(key)
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+        try:
+            os.link(path, blob)
+        except OSError as e:
+            # already stored by another publish, or on another filesystem.
+            if e.errno not in (errno.EEXIST, errno.EXDEV): raise
+
+    def report(self):
+        """
+            This session's files, frames linked to existing blobs, and bytes saved.
+        """
+
+        with self.__lock:
+            return {'files': self.files, 'linked': self.linked, 'bytesSaved': self.bytesSaved}
+
+    def usage(self):
+        """
+            The whole store's blobs, their total bytes, the publishes referring to them
+            and the bytes those publishes would take without de-duplication.
+        """
+
+        usage = {'blobs': 0, 'bytes': 0, 'references': 0, 'bytesSaved': 0}
+        for blob in self.__blobs():
+            stat = os.stat(blob)
+            references = stat.st_nlink - 1
+
+            usage['blobs'] += 1
+            usage['bytes'] += stat.st_size
+            usage['references'] += references
+            usage['bytesSaved'] += stat.st_size * max(references - 1, 0)
+
+        return usage
+
+    def verify(self):
+        """
+            Re-hash every blob, returning those whose content no longer matches their name -
+            e.g. a source modified in place after it was hardlinked into a publish.
+        """
+        return [blob for blob in self.__blobs() if self.key(blob) != os.path.basename(blob)]
+
+    def __blobs(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                yield os.path.join(directory, name)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Report on (or verify) an HDX frame store.')
+    parser.add_argument('command', choices = ('report', 'verify'))
+    parser.add_argument('root', help = 'the store directory')
+    args = parser.parse_args()
+
+    store = HDXFrameStore(args.root)
+
+    if args.command == 'report':
+        usage = store.usage()
+        print '%d blobs, %.1f GB stored, %d references, %.1f GB saved' % (
+            usage['blobs'], usage['bytes'] / 1e9, usage['references'], usage['bytesSaved'] / 1e9)
+        return
+
+    corrupt = store.verify()
+    for blob in corrupt: print 'corrupt: %s' % blob
+    print '%d corrupt blobs' % len(corrupt)
+    sys.exit(1 if corrupt else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+    Client side file transfer for publishes - clones files where the filesystem allows
+    it and copies them in parallel where it does not.
+"""
+
+import os
+import glob
+import errno
+import shutil
+import hashlib
+import threading
+from Queue import Queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from hdxutils import HDXError, statCache
+from hdxmedia import sequencePattern
+
+FICLONE = 0x40049409
+"""Linux ioctl cloning a file's extents into another (btrfs, XFS, etc.)."""
+
+class HDXTransfer(object):
+    """
+        Transfers a file, image sequence or directory into a destination directory.
+
+        Each file is transferred by the first of `modes` that succeeds:
+
+        reflink     - copy-on-write clone, instant and independent of the source.
+        hardlink    - a second name for the source's data, instant. Opt-in, and only
+                      for sources that are never modified in place - re-rendering a
+                      hardlinked source changes the published version too.
+        copy        - sendfile where available, otherwise a buffered copy.
+
+        Files are transferred by a pool of `workers` threads. With `checksum` (any
+        hashlib algorithm, e.g. 'md5') every file's digest is returned, and
+        `progress(files, totalFiles, bytes, totalBytes)` is called after each file.
+
+        With a `store` (an HDXFrameStore) frames already in the store are hardlinked to
+        it instead (mode 'dedup'), and new frames are added to it. New frames are then
+        never hardlinked to their source - the store would link every later version
+        to the artist's file.
+    """
+
+    chunkSize = 8 * 1024 * 1024
+    """Buffer size for copies that cannot use sendfile."""
+
+    def __init__(self, workers = 8, modes = ('reflink', 'copy'), checksum = None, progress = None, store = None):
+        for mode in modes:
+            if mode not in ('reflink', 'hardlink', 'copy'):
+                raise HDXError('HDXTransfer mode [%s] is not one of reflink, hardlink, copy.' % mode)
+
+        self.workers = workers
+        self.modes = modes
+        self.checksum = checksum
+        self.progress = progress
+        self.store = store
+        self.__lock = threading.Lock()
+
+    def files(self, source):
+        """
+            The files making up source - a file, a sequence in sprintf notation,
+            or a directory (recursively).
+        """
+
+        if os.path.isdir(source):
+            files = []
+            for directory, _, names in os.walk(source):
+                files.extend(os.path.join(directory, name) for name in names)
+            return sorted(files)
+
+        if os.path.isfile(source): return [source]
+
+        return sorted(glob.glob(sequencePattern.sub(r'*.\2', source)))
+
+    def transfer(self, source, destination):
+        """
+            Transfer source into the destination directory, returning {path: (mode, digest)}
+            for each transferred file. Raises HDXError naming any files that failed.
+        """
+
+        files = self.files(source)
+        if not files: raise HDXError('HDXTransfer found nothing to transfer at %s' % source)
+
+        # directories keep their structure, sequences and files land in destination.
+        root = source if os.path.isdir(source) else os.path.dirname(files[0])
+        jobs = [(f, os.path.join(destination, os.path.relpath(f, root))) for f in files]
+
+        state = {'files': 0, 'bytes': 0, 'totalBytes': sum(os.path.getsize(f) for f in files)}
+        results = {}
+        errors = []
+
+        def work():
+            while True:
+                job = queue.get()
+                try:
+                    if job is None: return
+
+                    source, target = job
+                    result = self.__transfer(source, target)
+
+                    with self.__lock:
+                        results[target] = result
+                        state['files'] += 1
+                        state['bytes'] += os.path.getsize(source)
+                        if self.progress:
+                            self.progress(state['files'], len(jobs), state['bytes'], state['totalBytes'])
+                except Exception as e:
+                    with self.__lock: errors.append('%s (%s)' % (job[0], e))
+                finally:
+                    queue.task_done()
+
+        # a bounded queue keeps memory flat however long the sequence.
+        workers = max(1, min(self.workers, len(jobs)))
+        queue = Queue(workers * 2)
+        threads = [threading.Thread(target = work) for i in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for job in jobs: queue.put(job)
+        for thread in threads: queue.put(None)
+        for thread in threads: thread.join()
+
+        statCache.invalidate(destination)
+
+        if errors:
+            raise HDXError('HDXTransfer failed for %d of %d files: %s' % (len(errors), len(jobs), ', '.join(errors)))
+
+        return results
+
+    def __transfer(self, source, target):
+        directory = os.path.dirname(target)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+        # a publish never overwrites.
+        if os.path.lexists(target): raise OSError(errno.EEXIST, 'destination exists', target)
+
+        if self.store is None: return self.__place(source, target, self.modes)
+
+        key = self.store.key(source)
+        if self.store.link(key, target): return 'dedup', self.__digest(target)
+
+        # the blob must be a file of its own, not another name for the source.
+        result = self.__place(source, target, [mode for mode in self.modes if mode != 'hardlink'] or ['copy'])
+        self.store.add(key, target)
+        return result
+
+    def __place(self, source, target, modes):
+        for mode in modes:
+            if mode == 'copy': return mode, self.__copy(source, target)
+
+            try:
+                if mode == 'reflink': self.__reflink(source, target)
+                else: os.link(source, target)
+            except (IOError, OSError) as e:
+                # another filesystem, or one without reflinks - try the next mode.
+                if e.errno == errno.EEXIST: raise
+                if os.path.lexists(target) and mode == 'reflink': os.remove(target)
+                continue
+
+            return mode, self.__digest(source)
+
+        raise IOError(errno.EXDEV, 'no transfer mode succeeded', source)
+
+    def __reflink(self, source, target):
+        if fcntl is None: raise IOError(errno.EOPNOTSUPP, 'reflinks need fcntl')
+
+        with open(source, 'rb') as sourceFile:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            try:
+                fcntl.ioctl(fd, FICLONE, sourceFile.fileno())
+            finally:
+                os.close(fd)
+
+    def __copy(self, source, target):
+        """
+            Copy source to target - hashing as it goes when a checksum is wanted.
+        """
+
+        digest = hashlib.new(self.checksum) if self.checksum else None
+        sendfile = getattr(os, 'sendfile', None)
+
+        with open(source, 'rb') as sourceFile:
+            with open(target, 'wb') as targetFile:
+                if sendfile and digest is None:
+                    size = os.fstat(sourceFile.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        sent = sendfile(targetFile.fileno(), sourceFile.fileno(), offset, min(self.chunkSize, size - offset))
+                        if not sent: break
+                        offset += sent
+                elif digest is None:
+                    shutil.copyfileobj(sourceFile, targetFile, self.chunkSize)
+                else:
+                    while True:
+                        chunk = sourceFile.read(self.chunkSize)
+                        if not chunk: break
+                        digest.update(chunk)
+                        targetFile.write(chunk)
+
+        shutil.copystat(source, target)
+        return digest.hexdigest() if digest else None
+
+    def __digest(self, path):
+        if not self.checksum: return None
+
+        digest = hashlib.new(self.checksum)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunkSize), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
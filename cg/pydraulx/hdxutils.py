@@ -5,41 +5,186 @@
 import sys
 import os
 import re
-from collections import deque
+import time
+import weakref
+import threading
+from collections import deque, OrderedDict, namedtuple
 
 from mavis import Mavis
 
-class HDXPath(object):
+class HDXParsedPath(namedtuple('HDXParsedPath', 'path components type name fileName')):
     """
-        Base Class for all HDX Entities (physical and virtual) and HDX Media Classes.
+        Immutable result of parsing an HDX path - the normalized path, its (type, name)
+        component pairs, the last pair's type and name, and the file name (if any).
+    """
+
+    __slots__ = ()
+
+class HDXPathParser(object):
+    """
+        Normalizes HDX paths and splits them into (type, name) component pairs.
+
+        Results are memoized in a least-recently-used cache of `size` raw paths, so
+        walkers parsing the same paths over and over only pay for the first parse.
+    """
+
+    mountPattern = re.compile(r"(?:(?:\/?hdx\/)|(?:\/?mnt\/[xz]\d+\/))?\/?projects\/")
+    """Matches any of the mounts a project may be reached through."""
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, size = 50000):
+        self.size = size
+        self.__parsed = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def parse(self, path):
+        """
+            Return the HDXParsedPath for path.
+        """
+
+        with self.__lock:
+            parsed = self.__parsed.pop(path, None)
+            if parsed is not None:
+                self.__parsed[path] = parsed
+                self.hits += 1
+                return parsed
+
+        parsed = self.__parse(path)
+
+        with self.__lock:
+            self.misses += 1
+            self.__parsed[path] = parsed
+            while len(self.__parsed) > self.size:
+                self.__parsed.popitem(last = False)
+
+        return parsed
+
+    def __parse(self, path):
+        path = self.mountPattern.sub(os.path.join(os.path.sep,'hdx','projects',''), path)
+
+        # first element after split is an empty string, the second is 'hdx'.
+        components = path.split(os.path.sep)[2:]
+        fileName = None
+
+        # non-even components indicate the presence of a file name.
+        if len(components) % 2 == 1:
+            fileName = components[-1]
+            components = components[:-1]
+
+        # break the path up into (component, name) pairs - interned, as the same
+        # types and names recur across thousands of paths. Interned strings are freed
+        # with their last reference, so this holds nothing beyond the LRU above.
+        pairs = []
+        for i in xrange(0,len(components),2):
+            pairs.append((internName(components[i]), internName(components[i+1])))
+
+        type = name = None
+        if pairs:
+            type, name = pairs[-1]
+
+            # the name may also be the file name.
+            if os.path.splitext(name)[1] != '': fileName = name
+
+        return HDXParsedPath(path, tuple(pairs), type, name, fileName)
+
+pathParser = HDXPathParser()
+"""The parser shared by all HDXPaths."""
+
+def internName(name):
+    """
+        Intern a path component - only str can be interned, so unicode (e.g. paths
+        decoded from Mavis JSON) is returned as is.
+    """
+    return intern(name) if type(name) is str else name
+
+def parsePath(path):
+    """
+        Parse path with the shared, memoized parser - see HDXPathParser.
     """
+    return pathParser.parse(path)
 
-    mavis = None
-    """An instance of the Mavis class, used to communicate with the Mavis server."""
+class HDXStatCache(object):
+    """
+        Caches os.stat results - including misses - for `ttl` seconds, so walks over
+        NFS do not stat the same paths over and over. A ttl of 0 disables the cache.
+
+        HDX writes (make, move, copy, remove) invalidate the paths they touch - anything
+        changed behind HDX's back may be seen up to `ttl` seconds late. Pass
+        `forceCheck = True` where that matters.
+    """
 
-    path = None
-    """Absolute path, the primary identity and string representation of the class."""
-   
-    source = None
-    """The path, as given to HDXPath.__init__ before any manipulation"""
-    
-    type = None
-    """Derived from path (or set by subclass) - the containing or "category" directory."""
+    def __init__(self, ttl = 2, size = 100000):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__stats = OrderedDict()
+        self.__lock = threading.Lock()
 
-    name = None
-    """Derived from path - the terminating or "name" directory."""
+    def stat(self, path, forceCheck = False):
+        """
+            os.stat(path), or None if path does not exist.
+        """
 
-    fileName = None
-    """Derived from path - a specific file (or sprintf-notation sequence name) inside the "name" directory."""
+        now = time.time()
+        if self.ttl and not forceCheck:
+            with self.__lock:
+                entry = self.__stats.get(path)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    return entry[1]
 
-    components = {}
-    """Component names indexed by type."""
+        try: result = os.stat(path)
+        except OSError: result = None
 
-    paths = {}
-    """Component paths indexed by type."""
+        with self.__lock:
+            self.misses += 1
+            if self.ttl:
+                self.__stats.pop(path, None)
+                self.__stats[path] = (now + self.ttl, result)
+                while len(self.__stats) > self.size:
+                    self.__stats.popitem(last = False)
 
-    metadata = {}
-    """Mavis metadata for this and all component entities."""
+        return result
+
+    def exists(self, path, forceCheck = False):
+        return self.stat(path, forceCheck) is not None
+
+    def invalidate(self, path):
+        """
+            Drop path and everything under it.
+        """
+
+        prefix = path.rstrip(os.path.sep) + os.path.sep
+        with self.__lock:
+            for key in [key for key in self.__stats if key == path or key.startswith(prefix)]:
+                del self.__stats[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__stats.clear()
+
+statCache = HDXStatCache()
+"""The stat cache shared by all HDXPaths."""
+
+class HDXPath(object):
+    """
+        Base Class for all HDX Entities (physical and virtual) and HDX Media Classes.
+
+        Instances are compact (__slots__) and hold only their own state:
+
+        mavis       - an instance of the Mavis class, used to communicate with the Mavis server.
+        path        - absolute path, the primary identity and string representation of the class.
+        source      - the path, as given to HDXPath.__init__ before any manipulation.
+        type        - derived from path (or set by subclass) - the containing or "category" directory.
+        name        - derived from path - the terminating or "name" directory.
+        fileName    - derived from path - a specific file (or sprintf-notation sequence name) inside the "name" directory.
+        metadata    - Mavis metadata for this and all component entities.
+    """
+
+    __slots__ = ('mavis', 'path', 'source', '_type', 'name', 'fileName', '_metadata', '_components', '__weakref__')
 
     def __init__(self, source, name = None, mavis = None, **kwargs):
         """
@@ -48,14 +193,19 @@ class HDXPath(object):
             Mavis instance may also be passed.
         """
 
-        self.__name__ = self.__class__.__name__
+        self.mavis = None
+        self.name = None
+        self.fileName = None
+        self._metadata = None
+        self._type = None
+        self._components = ()
 
         if isinstance(source, HDXPath):
             self.mavis = source.mavis
 
-            # copy metadata to reduce bandwidth.
-            if source.exists():
-                self.metadata = dict(source.metadata)
+            # copy metadata to reduce bandwidth - only what the source has already loaded.
+            if source._metadata:
+                self.metadata = dict(source._metadata)
 
         elif not isinstance(source, str):
             raise HDXError('HDXPath first arg must be HDXPath or String (source).')
@@ -79,6 +229,49 @@ class HDXPath(object):
 
         self._parsePath()
 
+        # share one string when normalization left the path unchanged.
+        if self.source == self.path: self.source = self.path
+
+    @property
+    def __name__(self):
+        return self.__class__.__name__
+
+    @property
+    def metadata(self):
+        """Created on first use - most paths never need one."""
+
+        if self._metadata is None: self._metadata = {}
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    @property
+    def type(self):
+        return self._type
+
+    @type.setter
+    def type(self, value):
+        self._type = value
+
+    @property
+    def components(self):
+        """Component names indexed by type."""
+        return dict(self._components)
+
+    @property
+    def paths(self):
+        """Component paths indexed by type."""
+
+        paths = {}
+        path = os.path.join(os.path.sep, 'hdx')
+        for component, name in self._components:
+            path = os.path.join(path, component, name)
+            paths[component] = path
+
+        return paths
+
     def getPath(self, component = None, mavis = False):
         if component:
             try:
@@ -92,39 +285,29 @@ class HDXPath(object):
 
         return path
 
-    def exists(self, component = None):
-        return os.path.exists(self.getPath(component))
+    def exists(self, component = None, forceCheck = False):
+        """
+            Existence on the filesystem, from statCache unless forceCheck is True.
+        """
+        return statCache.exists(self.getPath(component), forceCheck)
 
     def _parsePath(self):
         """
             Normalize and extract component information from self.path.
         """
 
-        pattern = r"(?:(?:\/?hdx\/)|(?:\/?mnt\/[xz]\d+\/))?\/?projects\/"
-        self.path = re.sub(pattern, os.path.join(os.path.sep,'hdx','projects',''), self.path)
+        parsed = pathParser.parse(self.path)
 
-        # first element after split is an empty string, the second is 'hdx'.
-        components = self.path.split(os.path.sep)[2:]
-        
-        # non-even components indicate the presence of a file name.
-        if (len(components)) % 2 == 1:
-            self.fileName = components[-1:][0]
-            components = components[:-1]
-
-        # break the path up into (component, name) pairs.
-        for i in xrange(0,len(components),2):
-            self.components[components[i]] = components[i+1]
-            self.paths[components[i]] = os.path.sep + os.path.join('hdx',*components[:i+2])
+        # parsed values are shared with every other HDXPath parsed from the same string.
+        self.path = parsed.path
+        self._components = parsed.components
+        if parsed.fileName: self.fileName = parsed.fileName
 
-            # the last iteration yields the type (if not already defined) and name.
-            if i == (len(components)-2):
-                self.name = components[i+1]
-                if not self.type: self.type = components[i]
-                elif self.type != components[i]:
-                    raise HDXError('%s defined type [%s] does not match parsed type [%s]' % (self.__name__, self.type, components[i]))
-
-        # self.name may also be the file name.
-        if os.path.splitext(self.name)[1] != '': self.fileName = self.name
+        if parsed.components:
+            self.name = parsed.name
+            if not self.type: self.type = parsed.type
+            elif self.type != parsed.type:
+                raise HDXError('%s defined type [%s] does not match parsed type [%s]' % (self.__name__, self.type, parsed.type))
 
     def __ls(self, path, directory, linkTable):
         """
@@ -159,19 +342,116 @@ class HDXPath(object):
         return self.path
 
 
+class HDXIdentityMap(object):
+    """
+        Session-scoped map of (normalized path, type) to the one live entity for it.
+
+        Pass `identityMap = ...` when constructing an HDXBaseEntity - constructing
+        another entity of the same type and path then returns the existing instance,
+        with whatever metadata it has already loaded. Entities built from a mapped
+        entity (e.g. an attribute's versions) join the same map. Values are weak,
+        so entities nothing else refers to are dropped.
+    """
+
+    def __init__(self):
+        self.__entities = weakref.WeakValueDictionary()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            return self.__entities.get(key)
+
+    def add(self, entity):
+        """
+            Map entity, returning the instance already mapped to its key if there is one.
+        """
+
+        with self.__lock:
+            return self.__entities.setdefault(entity._identity(), entity)
+
+    def discard(self, entity, key = None):
+        """
+            Unmap entity - from key, if given, rather than its current identity.
+        """
+
+        key = key or entity._identity()
+        with self.__lock:
+            if self.__entities.get(key) is entity: del self.__entities[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entities.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.__entities)
+
+class HDXEntityType(type):
+    """
+        Metaclass returning mapped instances from an HDXIdentityMap - see HDXBaseEntity.
+    """
+
+    def __call__(cls, *args, **kwargs):
+        identityMap = kwargs.get('identityMap')
+        if identityMap is None and args: identityMap = getattr(args[0], '_identityMap', None)
+        if identityMap is None or not isinstance(cls.type, str):
+            return super(HDXEntityType, cls).__call__(*args, **kwargs)
+
+        # build the key the way HDXPath.__init__ builds the path.
+        source = args[0] if args else kwargs.get('source')
+        name = args[1] if len(args) > 1 else kwargs.get('name')
+
+        path = str(source)
+        if not isinstance(name, Mavis) and isinstance(cls.type, str): path = os.path.join(path, cls.type)
+        if isinstance(name, str): path = os.path.join(path, name)
+
+        entity = identityMap.get((parsePath(path).path, cls.type))
+        if entity is not None and type(entity) is cls: return entity
+
+        kwargs['identityMap'] = identityMap
+        return identityMap.add(super(HDXEntityType, cls).__call__(*args, **kwargs))
+
 class HDXBaseEntity(HDXPath):
     """
         Base Class for all Physical HDX Entities - entities present both in Mavis and on the filesystem.
     """
 
+    __metaclass__ = HDXEntityType
+
+    __slots__ = ('_loaded', '_identityMap')
+
     def __init__(self, *args, **kwargs):
+        self._loaded = False
+        self._identityMap = kwargs.get('identityMap')
         super(HDXBaseEntity, self).__init__(*args, **kwargs)
 
         if not self.mavis:
             raise HDXError('%s must be supplied with an authenticated Mavis instance.' % self.__name__)
 
-        if self.exists():
-            self.__loadMetadata()
+        # an HDXIndex built from one bulk query saves a roundtrip per entity.
+        index = kwargs.get('index')
+        metadata = index.metadata(self.path) if index is not None else None
+        if metadata:
+            # straight to _metadata - the metadata property would load from Mavis first.
+            self._metadata = dict(self._metadata or {})
+            self._metadata.update(metadata)
+            self._loaded = True
+
+    @property
+    def metadata(self):
+        """Loaded from Mavis on first use - see prefetch to load many entities at once."""
+
+        if not self._loaded:
+            if self.exists(): self.__loadMetadata()
+            self._loaded = True
+
+        return super(HDXBaseEntity, self).metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
 
     def getMetadata(self, field = None, component = None, default = None):
         """
@@ -199,6 +479,8 @@ class HDXBaseEntity(HDXPath):
             Raises OSError if entity already exists.
         """
 
+        # never trust a cached miss here - it could let make clobber an existing entity.
+        statCache.invalidate(self.path)
         if self.exists():
             raise OSError(17, '%s already exists.' % self.__name__, self.path)
 
@@ -207,13 +489,27 @@ class HDXBaseEntity(HDXPath):
         else: path = self.path
 
         self.metadata[self.type] = self._callMavis('mk', path, metadata, **params)
+        statCache.invalidate(path)
+        statCache.invalidate(self.path)
+        if self._identityMap is not None: self._identityMap.add(self)
 
     def update(self, metadata, **params):
         """
             Update metadata (i.e. non-filesystem data).
+
+            Inside `with HDXBatch():` the call to Mavis is deferred and merged with
+            other updates to the same path.
         """
-        self.metadata[self.type].update(metadata)
-        self._callMavis('update', self.path, metadata, **params)
+
+        batch = HDXBatch.current()
+        if batch is not None:
+            current = self.metadata[self.type]
+            changed = dict((k, v) for k, v in metadata.items() if k not in current or current[k] != v)
+            self.metadata[self.type].update(metadata)
+            batch.add(self, changed, **params)
+        else:
+            self.metadata[self.type].update(metadata)
+            self._callMavis('update', self.path, metadata, **params)
         
     def move(self, destination):
         """
@@ -237,9 +533,12 @@ class HDXBaseEntity(HDXPath):
         if source: path = self.source
         else: path = self.path
 
-        if os.path.exists(path):
-            return self._callMavis('rm', path)
-        else: return True
+        if not statCache.exists(path, forceCheck = True): return True
+
+        removed = self._callMavis('rm', path)
+        statCache.invalidate(path)
+        if removed and not source and self._identityMap is not None: self._identityMap.discard(self)
+        return removed
 
     def list(self, directory, linkTable = None):
         """
@@ -257,48 +556,170 @@ class HDXBaseEntity(HDXPath):
         if not isinstance(destination, HDXPath):
             destination = HDXPath(destination)
 
-        if destination.exists():
+        if destination.exists(forceCheck = True):
             raise OSError(17, '%s.%s - destination exists.' % (self.__name__, method), self.path)
 
         if destination.type != self.type:
             raise HDXError('%s.%s cannot alter entity type - [%s to %s]' % (self.__name__, method, self.type, destination.type))
 
         # update metadata, path, and components.
+        key = self._identity()
         self.metadata[self.type] = self._callMavis(method, self.path, destination.path)
+        statCache.invalidate(self.path)
+        statCache.invalidate(destination.path)
         self.path = self.metadata[self.type]['path']
         self._parsePath()
 
+        # this instance now stands for the destination.
+        if self._identityMap is not None:
+            self._identityMap.discard(self, key)
+            self._identityMap.add(self)
+
+    def _identity(self):
+        """
+            Key of this entity in an HDXIdentityMap.
+        """
+        return (self.path, self.type)
+
     def __loadMetadata(self):
         """
             Load metadata from Mavis - only for components that do not already have metadata.
         """
 
         # to reduce bandwidth usage and database roundtrips, only get metadata for this entity.
-        if self.metadata:
-            self.metadata[self.type] = self._callMavis('get', self.path)[self.type]
+        if self._metadata:
+            self._metadata[self.type] = self._callMavis('get', self.path)[self.type]
         else:
-            self.metadata = self._callMavis('get', self.path, iterate=True)
+            self._metadata = self._callMavis('get', self.path, iterate=True)
+
+def prefetch(entities):
+    """
+        Load metadata for many HDXBaseEntities at once, with Mavis.entitiesForPaths -
+        a request per Mavis.maxUrlLength of URL rather than a roundtrip per entity.
+
+        Components shared by several entities (e.g. their project) are fetched once.
+        Entities Mavis does not return are left to load lazily, as without prefetch.
+    """
+
+    # HDX paths live under /hdx, Mavis paths do not.
+    mavisPath = lambda path: path[len(os.path.join(os.path.sep, 'hdx')):]
+
+    pending = {}
+    for entity in entities:
+        if not entity._loaded: pending.setdefault(entity.mavis, []).append(entity)
+
+    for mavis, group in pending.items():
+        paths = set()
+        for entity in group:
+            paths.update(mavisPath(path) for path in entity.paths.values())
+
+        found = mavis.entitiesForPaths(paths)
+
+        for entity in group:
+            if mavisPath(entity.path) not in found: continue
+
+            metadata = entity._metadata or {}
+            for type, path in entity.paths.items():
+                if mavisPath(path) in found: metadata[type] = found[mavisPath(path)]
+
+            entity.metadata = metadata
+            entity._loaded = True
+
+class HDXBatch(object):
+    """
+        Write-behind batching of HDXBaseEntity.update calls.
+
+        Within `with HDXBatch():` updates are held back and merged per path, then
+        sent as a single PUT per path containing only the changed keys - by flush(),
+        which runs automatically when the block exits.
+    """
+
+    __local = threading.local()
+
+    def __init__(self):
+        self.__pending = OrderedDict()
+
+    @classmethod
+    def current(cls):
+        """
+            The innermost active batch of this thread, or None.
+        """
+
+        stack = getattr(cls.__local, 'stack', None)
+        if stack: return stack[-1]
+        return None
+
+    def add(self, entity, metadata, **params):
+        """
+            Merge metadata into the pending update for entity's path.
+        """
+
+        if not metadata: return
+
+        key = (entity.path, tuple(sorted(params.items())))
+        if key not in self.__pending: self.__pending[key] = (entity, {}, params)
+        self.__pending[key][1].update(metadata)
+
+    def flush(self):
+        """
+            Send all pending updates - one call to Mavis per path. If a call raises, it
+            and every update not yet sent stay pending, so flush can be retried.
+        """
+
+        for key in self.__pending.keys():
+            entity, metadata, params = self.__pending[key]
+            entity._callMavis('update', key[0], metadata, **params)
+            del self.__pending[key]
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def __enter__(self):
+        if not hasattr(self.__local, 'stack'): self.__local.stack = []
+        self.__local.stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.__local.stack.remove(self)
+        self.flush()
+        return False
 
 class HDXBaseVirtualEntity(HDXBaseEntity):
     """
         Base class for all Virtual HDX Entities - entities present only in Mavis, not on the filesystem.
     """
 
+    __slots__ = ('__exists',)
+
     def __init__(self, *args, **kwargs):
         """
             A virtual entity's path must NOT contain "virtual" directories.
         """
 
+        self.__exists = False
         super(HDXBaseVirtualEntity, self).__init__(*args, **kwargs)
         
         components = self.path.split(os.path.sep)
         self.path = os.path.join(os.path.sep, *components[:components.index(self.type)])
-        self.paths[self.type] = self.path
 
         # the parent constructor will never call __loadMetadata because self.exists() will
         # always return False - this version of __loadMetadata also checks for existence.
         self.__loadMetadata()
 
+    @property
+    def paths(self):
+        """Component paths indexed by type - a virtual entity's own path is its physical parent."""
+
+        paths = super(HDXBaseVirtualEntity, self).paths
+        paths[self.type] = self.path
+        return paths
+
+    def _identity(self):
+        """
+            A virtual entity's path is its physical parent - its type and name make it unique.
+        """
+        return (os.path.join(self.path, self.type, self.name), self.type)
+
     def exists(self, component = None, forceCheck = False):
         """
             Mavis must be queried to determine existence of virtual entities.
@@ -306,7 +727,7 @@ class HDXBaseVirtualEntity(HDXBaseEntity):
 
         # all sub-components of a virtual entity are physical.
         if component and component != self.type:
-            return super(HDXBaseVirtualEntity, self).exists(component)
+            return super(HDXBaseVirtualEntity, self).exists(component, forceCheck)
 
         # forcing a check requires a roundtrip to Mavis - only use when necessary.
         if forceCheck is True:
@@ -347,14 +768,14 @@ class HDXBaseVirtualEntity(HDXBaseEntity):
                 else: raise e
             self.__exists = True
 
-    __exists = False
-
 
 class HDXBaseMedia(HDXPath):
     """
         Base Class for all HDX Media Classes - classes representing working files that could be made deliverable.
     """
 
+    __slots__ = ()
+
     jobDefaults = {}
     """Default options to pass to Mavis.lucy - subclasses will define these defaults."""
 
@@ -2,63 +2,297 @@
     Low-Level Communication with the Mavis API.
 """
 
+import os
+import re
+import sys
+import zlib
+import errno
+import time
+import atexit
+import random
+import struct
+import stat
+import getpass
+import logging
+import tempfile
+import urllib
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking (Windows) - rate limiting is per-process only.
+    fcntl = None
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from requests.utils import dict_from_cookiejar, cookiejar_from_dict
 import json
 
+# every request is logged at DEBUG level - enable with logging.getLogger('mavis').setLevel(logging.DEBUG)
+log = logging.getLogger('mavis')
+
 class Mavis(object):
 
     session = None
     """The encrypted session cookie identifying this particular Mavis instance."""
 
-    def __init__(self, username, password, host = 'localhost', port = '3000', loginUrl = 'api/users/login'):
+    http = None
+    """A pooled, keep-alive requests.Session shared by every query of this Mavis instance."""
+
+    timeout = 30
+    """Seconds to wait for Mavis to respond before raising MavisError."""
+
+    cache = None
+    """Optional MavisCache of GET responses - None disables caching."""
+
+    validators = None
+    """Optional MavisValidators used to send conditional GETs - None disables them."""
+
+    retry = None
+    """Optional MavisRetry policy for failed idempotent requests - None disables retrying."""
+
+    breaker = None
+    """Optional MavisCircuitBreaker shared by all requests - None disables it."""
+
+    transientStatuses = (502, 503, 504)
+    """Response codes meaning Mavis is overloaded or restarting, rather than the request being bad."""
+
+    sessionFile = os.path.join('~', '.mavis', 'sessions.json')
+    """Where persisted session cookies are kept, readable only by their owner."""
+
+    sessionTtl = 12 * 60 * 60
+    """Seconds a persisted session cookie is reused before logging in afresh."""
+
+    metrics = None
+    """MavisStats recording the requests this instance sends."""
+
+    codec = None
+    """MavisCodec encoding request bodies and decoding responses."""
+
+    rateLimiter = None
+    """Optional MavisRateLimiter every request must pass - None disables limiting."""
+
+    maxUrlLength = 8000
+    """Longest URL a batched lookup sends - longer lists are split across several requests."""
+
+    def __init__(self, username, password, host = 'localhost', port = '3000', loginUrl = 'api/users/login',
+                 poolSize = 10, timeout = 30, cache = None, validators = None, retry = None, breaker = None,
+                 persistSession = False, statsFile = None, codec = None, rateLimiter = None):
         """
             Please see the docs concerning Mavis authentication.
+
+            `poolSize` is the number of keep-alive connections kept open to Mavis,
+            `timeout` the number of seconds to wait on any single request,
+            `cache` an optional MavisCache for GET responses, `validators`
+            an optional MavisValidators for conditional (ETag) GETs, `retry` an
+            optional MavisRetry and `breaker` an optional MavisCircuitBreaker.
+
+            With `persistSession` the session cookie is saved to sessionFile and
+            reused by later instances until it expires, skipping the login request.
+
+            If `statsFile` is given, `stats()` is dumped to it as JSON at process exit.
+            `codec` replaces the default MavisCodec (fastest installed JSON library,
+            uncompressed request bodies). `rateLimiter` is an optional MavisRateLimiter,
+            usually shared by every Mavis client on the host.
         """
 
         self.host = host
         self.port = port
         self.username = username
+        self.timeout = timeout
+        self.cache = cache
+        self.validators = validators
+        self.retry = retry
+        self.breaker = breaker
+        self.metrics = MavisStats()
+        self.codec = codec or MavisCodec()
+        self.rateLimiter = rateLimiter
+        self.http = self._createSession(poolSize)
+        self.__cookieLock = threading.Lock()
+        self.__inFlight = {}
+        self.__inFlightLock = threading.Lock()
+        self.__credentials = {'password':password, 'username': username}
+        self.loginUrl = '/' + loginUrl.lstrip('/')
+        self.persistSession = persistSession
+
+        if statsFile: atexit.register(self.metrics.dump, statsFile)
+
+        if not (persistSession and self._loadSession()):
+            self.login()
+
+    def stats(self):
+        """
+            Request counts, latency histograms, bytes transferred and errors per endpoint.
+        """
+        return self.metrics.snapshot()
 
-        self.query('post', loginUrl, {'password':password, 'username': username})
+    def login(self):
+        """
+            Log in to Mavis, replacing (and optionally persisting) the session cookie.
+        """
+
+        self.query('post', self.loginUrl, self.__credentials)
+        if self.persistSession: self._saveSession()
+
+    def _sessionKey(self):
+        return '%s@%s:%s' % (self.username, self.host, self.port)
+
+    def _readSessions(self):
+        try:
+            with open(os.path.expanduser(self.sessionFile)) as sessionFile:
+                sessions = json.load(sessionFile)
+        except (IOError, ValueError):
+            return {}
+
+        return sessions if isinstance(sessions, dict) else {}
+
+    def _loadSession(self):
+        """
+            Reuse a persisted, unexpired session cookie. Returns True if one was found.
+        """
+
+        stored = self._readSessions().get(self._sessionKey())
+        try:
+            if not stored or stored['expires'] < time.time(): return False
+            self.session = cookiejar_from_dict(stored['cookies'])
+        except (KeyError, TypeError, AttributeError):
+            # a malformed entry - log in as if there were none.
+            return False
+
+        return True
+
+    def _saveSession(self):
+        """
+            Persist the session cookie - the file is written atomically with 0600
+            permissions inside a 0700 directory.
+        """
+
+        if not self.session: return
+
+        path = os.path.expanduser(self.sessionFile)
+
+        # jobs starting together on a fresh node race to create the directory.
+        try:
+            os.makedirs(os.path.dirname(path), 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+        sessions = self._readSessions()
+        sessions[self._sessionKey()] = {
+            'cookies': dict_from_cookiejar(self.session),
+            'expires': time.time() + self.sessionTtl
+        }
+
+        # a unique 0600 temporary - threads of one process share a pid.
+        descriptor, temporary = tempfile.mkstemp(prefix = os.path.basename(path) + '.', dir = os.path.dirname(path))
+        with os.fdopen(descriptor, 'w') as sessionFile:
+            json.dump(sessions, sessionFile)
+        os.rename(temporary, path)
 
     def get(self, path, **params):
         """ READ """
-        return self.query('get', path, data = None, **params).json()
+        return self.codec.loads(self.query('get', path, data = None, **params).content)
 
     def post(self, path, data, **params):
         """ CREATE """
-        return self.query('post', path, data = data, **params).json()
+        return self.codec.loads(self.query('post', path, data = data, **params).content)
 
     def put(self, path, data, **params):
         """ UPDATE """
-        return self.query('put', path, data = data, **params).json()
+        return self.codec.loads(self.query('put', path, data = data, **params).content)
 
     def delete(self, path, **params):
         """ DELETE """
-        return self.query('delete', path, data = None, **params).json()
+        return self.codec.loads(self.query('delete', path, data = None, **params).content)
+
+
+    def entitiesForPaths(self, entityPaths):
+        """
+            Look up many entities by (Mavis) path, with one `path inq [...]` request per
+            maxUrlLength of URL rather than a roundtrip per path.
+
+            Returns a dict of path to entity - paths unknown to Mavis are left out.
+        """
+
+        if not entityPaths: return {}
+
+        entities = {}
+        for params in self._inqChunks('/api/Entities', 'path', entityPaths):
+            result = self.get('/api/Entities', **params)
+
+            # a 404 passes through as an error dict rather than a list.
+            if not isinstance(result, list): continue
+            for entity in result:
+                entities[entity['path']] = entity
 
+        return entities
 
     def find(self, path, **params):
         """ DEPRECATED -- use `get` instead """
-        return self.query('get', path, data = None, **params).json()
+        return self.codec.loads(self.query('get', path, data = None, **params).content)
 
     def insert(self, path, data, **params):
         """ DEPRECATED -- use `post` instead """
-        return self.query('post', path, data = data, **params).json()
+        return self.codec.loads(self.query('post', path, data = data, **params).content)
 
     def update(self, path, data, **params):
         """ DEPRECATED -- use `put` instead """
-        return self.query('put', path, data = data, **params).json()
+        return self.codec.loads(self.query('put', path, data = data, **params).content)
 
     def action(self, action, path, data):
         """ DEPRECATED """
         if path[0] == '/': path = path[1:]
-        return self.query('put', '/action/%s/%s' % (action, path), data = data).json()
+        return self.codec.loads(self.query('put', '/action/%s/%s' % (action, path), data = data).content)
 
     def remove(self, path, **params):
         """ DEPRECATED -- use `delete` instead """
         return self.query('delete', path, data = None, **params)
 
+    def close(self):
+        """
+            Close all pooled connections to Mavis.
+        """
+        self.http.close()
+
+    def _inqChunks(self, url, field, values):
+        """
+            Split values into stringified LoopBack `filter` params of the form
+            {"where": {field: {"inq": [...]}}}, keeping each URL under maxUrlLength.
+        """
+
+        # the URL and filter without any values, then each value's encoded length.
+        emptyFilter = urllib.urlencode({'filter': json.dumps({'where': {field: {'inq': []}}})})
+        baseLength = len(''.join(['http://', self.host, ':', self.port, url, '?', emptyFilter]))
+
+        chunks = [[]]
+        length = baseLength
+        for value in sorted(set(values)):
+            valueLength = len(urllib.quote_plus(json.dumps(value) + ', '))
+
+            if chunks[-1] and length + valueLength > self.maxUrlLength:
+                chunks.append([])
+                length = baseLength
+
+            chunks[-1].append(value)
+            length += valueLength
+
+        return [{'filter': json.dumps({'where': {field: {'inq': chunk}}})} for chunk in chunks]
+
+    def _createSession(self, poolSize):
+        """
+            Build the keep-alive session all queries share, so sequential calls reuse
+            open connections instead of paying for a new TCP handshake each time.
+        """
+
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections = poolSize, pool_maxsize = poolSize)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
+
     def query(self, method, path, data = None, **params):
         """
             Perform the Mavis query.
@@ -66,7 +300,7 @@ class Mavis(object):
 
         contentType = 'application/json'
 
-        if isinstance(data, dict) or isinstance(data, list): data = json.dumps(data)
+        if isinstance(data, dict) or isinstance(data, list): data = self.codec.dumps(data)
         elif isinstance(data, str): contentType = 'text/plain'
         elif data is not None:
             raise TypeError('Data passed to Mavis must be a dictionary, list '
@@ -76,31 +310,607 @@ class Mavis(object):
         if path[0] != '/': path = '/%s' % path
         url = ''.join(['http://', self.host, ':', self.port, path])
 
-        print url
+        # serve reads from the cache, and drop cached reads that a write may change.
+        if self.cache is not None:
+            if method == 'get':
+                cacheKey = self.cache.key(path, params)
+                cached = self.cache.get(cacheKey)
+                if cached is not None: return cached
+            else: self.cache.invalidate(path)
+
+        # concurrent identical reads share a single request.
+        if method == 'get':
+            key = (path, json.dumps(params, sort_keys = True))
+            return self.__joinInFlight(key, self._send, method, path, url, data, params, contentType)
+
         try:
-            resp = getattr(requests, method)(
-                url,
-                data            = data,
-                params          = params,
-                allow_redirects = False,
-                cookies         = self.session,
-                headers         = {'content-type': contentType}
-            )
-        except requests.exceptions.ConnectionError:
-            raise MavisError('Connection Refused - Mavis may be offline or unreachable.')
-        except Exception as e:
-            raise MavisError(500, e.args[0])
+            return self._send(method, path, url, data, params, contentType)
+        finally:
+            # again once the write has landed (or failed) - a read sent while it was in
+            # flight may have cached the old body.
+            if self.cache is not None: self.cache.invalidate(path)
+
+    def _send(self, method, path, url, data, params, contentType):
+        """
+            Send a single request to Mavis, raising MavisError on failure.
+        """
+
+        headers = {'content-type': contentType, 'accept-encoding': 'gzip'}
+
+        if self.codec.compresses(data):
+            data = self.codec.compress(data)
+            headers['content-encoding'] = 'gzip'
+
+        # ask Mavis to skip the body if it has not changed since the last GET.
+        if self.validators is not None and method == 'get':
+            validatorKey = self.validators.key(path, params)
+            headers.update(self.validators.headers(validatorKey))
+
+        # take a reference - concurrent responses replace, never mutate, the jar.
+        with self.__cookieLock: cookies = self.session
+
+        log.debug('%s %s', method.upper(), url)
+        attempt = 0
+        loggedIn = path == self.loginUrl
+        while True:
+            # a token first - allow() may make this request the half-open probe, which
+            # must then be recorded, and acquire() can raise.
+            if self.rateLimiter is not None: self.rateLimiter.acquire()
+            if self.breaker is not None: self.breaker.allow()
+
+            failure = None
+            started = time.time()
+            try:
+                resp = self.http.request(
+                    method,
+                    url,
+                    data            = data,
+                    params          = params,
+                    allow_redirects = False,
+                    cookies         = cookies,
+                    headers         = headers,
+                    timeout         = self.timeout
+                )
+            except requests.exceptions.Timeout:
+                failure = MavisError('Timed Out - Mavis did not respond within %s seconds.' % self.timeout)
+                self.metrics.record(method, path, time.time() - started, data, status = 'timeout')
+            except requests.exceptions.ConnectionError:
+                failure = MavisError('Connection Refused - Mavis may be offline or unreachable.')
+                self.metrics.record(method, path, time.time() - started, data, status = 'refused')
+            except Exception as e:
+                # a failed request - it must still settle a half-open breaker's probe.
+                self.metrics.record(method, path, time.time() - started, data, status = 'error')
+                if self.breaker is not None: self.breaker.record(False)
+                raise MavisError(500, e.args[0])
+            else:
+                self.metrics.record(method, path, time.time() - started, data, resp)
+
+            # unreachable or overloaded - worth retrying, and counts against the breaker.
+            transient = failure is not None or resp.status_code in self.transientStatuses
+            if self.breaker is not None: self.breaker.record(not transient)
+
+            if transient and self.retry is not None and self.retry.allows(method, attempt):
+                self.retry.wait(attempt)
+                attempt += 1
+                continue
+
+            if failure is not None: raise failure
+
+            # the (possibly persisted) session expired - log in again and resend once.
+            if resp.status_code == 401 and not loggedIn:
+                loggedIn = True
+                self.login()
+                with self.__cookieLock: cookies = self.session
+                continue
+
+            break
 
         if resp.cookies:
-            self.session = resp.cookies
+            with self.__cookieLock:
+                jar = RequestsCookieJar()
+                if self.session: jar.update(self.session)
+                jar.update(resp.cookies)
+                self.session = jar
 
         if resp.status_code > 399 and resp.status_code != 404:
             try: message = resp.json()['error']
             except: message = resp.text
             raise MavisError(resp.status_code, message)
 
+        if self.validators is not None and method == 'get':
+            if resp.status_code == 304:
+                resp = self.validators.stored(validatorKey) or resp
+            elif resp.status_code == 200:
+                self.validators.store(validatorKey, resp)
+
+        if self.cache is not None and method == 'get' and resp.status_code < 300:
+            self.cache.set(self.cache.key(path, params), resp)
+
+        return resp
+
+    def __joinInFlight(self, key, function, *args):
+        """
+            Call function(*args) unless a call for the same key is already running,
+            in which case wait for and share its result (or error).
+        """
+
+        with self.__inFlightLock:
+            call = self.__inFlight.get(key)
+            leader = call is None
+            if leader: call = self.__inFlight[key] = (threading.Event(), {})
+
+        done, outcome = call
+        if leader:
+            try:
+                outcome['value'] = function(*args)
+            except:
+                outcome['error'] = sys.exc_info()
+            finally:
+                with self.__inFlightLock:
+                    del self.__inFlight[key]
+                done.set()
+        else: done.wait()
+
+        if 'error' in outcome:
+            error = outcome['error']
+            raise error[0], error[1], error[2]
+        return outcome['value']
+
+def fastestJson():
+    """
+        The fastest JSON library installed - ujson, simplejson or the standard library.
+    """
+
+    for name in ('ujson', 'simplejson'):
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+
+    return json
+
+class MavisCodec(object):
+    """
+        Encodes Mavis request bodies and decodes responses.
+
+        `backend` is any module with json-style `dumps` and `loads`, by default the
+        fastest installed (see fastestJson). Request bodies larger than `gzipThreshold`
+        bytes are gzipped - leave it None unless Mavis accepts gzipped requests.
+        Gzipped responses are always accepted and decompressed by requests.
+    """
+
+    def __init__(self, backend = None, gzipThreshold = None):
+        self.backend = backend or fastestJson()
+        self.gzipThreshold = gzipThreshold
+
+    def dumps(self, data):
+        return self.backend.dumps(data)
+
+    def loads(self, content):
+        return self.backend.loads(content)
+
+    def compresses(self, body):
+        return self.gzipThreshold is not None and body is not None and len(body) > self.gzipThreshold
+
+    def compress(self, body):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+class MavisStats(object):
+    """
+        Per-endpoint request metrics: call counts, latency histograms, bytes sent and
+        received, and errors by status.
+
+        Endpoints are the method plus the path with entity names and ids replaced by
+        `*`, e.g. `GET /projects/*/shots/*`, so all calls of one kind are grouped.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    """Upper bounds (seconds) of the latency histogram buckets - slower calls fall in `inf`."""
+
+    __idPattern = re.compile('^(\d+|[0-9a-f]{24})$')
+
+    def __init__(self):
+        self.__endpoints = {}
+        self.__lock = threading.Lock()
+
+    def endpoint(self, method, path):
+        """
+            Group path into an endpoint by hiding names and ids.
+        """
+
+        components = path.split('?')[0].strip('/').split('/')
+
+        # HDX paths alternate type and name - /projects/<name>/shots/<name>/...
+        if components[0] in ('projects', 'hdx'):
+            start = 1 if components[0] == 'projects' else 2
+            for i in xrange(start, len(components), 2): components[i] = '*'
+        else:
+            components = ['*' if self.__idPattern.match(c) else c for c in components]
+
+        return '%s /%s' % (method.upper(), '/'.join(components))
+
+    def record(self, method, path, seconds, data = None, resp = None, status = None):
+        """
+            Record one request - `status` overrides the response's (e.g. 'timeout').
+        """
+
+        if status is None: status = resp.status_code
+        sent = len(data) if data else 0
+        received = len(resp.content) if resp is not None and resp.content else 0
+        bucket = next((b for b in self.buckets if seconds <= b), 'inf')
+
+        key = self.endpoint(method, path)
+        with self.__lock:
+            stats = self.__endpoints.get(key)
+            if stats is None:
+                stats = self.__endpoints[key] = {
+                    'calls': 0, 'seconds': 0.0, 'bytesSent': 0, 'bytesReceived': 0,
+                    'latency': dict((str(b), 0) for b in self.buckets + ('inf',)),
+                    'errors': {}
+                }
+
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['bytesSent'] += sent
+            stats['bytesReceived'] += received
+            stats['latency'][str(bucket)] += 1
+            if not isinstance(status, int) or status > 399:
+                stats['errors'][str(status)] = stats['errors'].get(str(status), 0) + 1
+
+    def snapshot(self):
+        """
+            A copy of all metrics, indexed by endpoint.
+        """
+
+        with self.__lock:
+            return json.loads(json.dumps(self.__endpoints))
+
+    def dump(self, path):
+        with open(path, 'w') as statsFile:
+            json.dump(self.snapshot(), statsFile, indent = 4, sort_keys = True)
+
+    def reset(self):
+        with self.__lock:
+            self.__endpoints.clear()
+
+class MavisRateLimiter(object):
+    """
+        Token bucket limiting requests to `rate` per second, with bursts of up to
+        `burst` requests.
+
+        The bucket lives in `stateFile` and is updated under an exclusive file lock,
+        so every process on the host naming the same file (by default, one per
+        `name` in the user's 0700 directory under stateRoot) shares one budget -
+        e.g. all ingest jobs on a render node. The file is never followed through a
+        symlink, and must belong to the user.
+    """
+
+    stateRoot = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    """
+        Node-local directory holding each user's `mavis-<user>` state directory - every
+        request touches the state file, so it must never be on a network filesystem.
+    """
+
+    waits = 0
+    """Number of requests that had to wait for a token."""
+
+    waited = 0.0
+    """Total seconds spent waiting for tokens."""
+
+    __state = struct.Struct('dd')
+
+    def __init__(self, rate = 20, burst = None, name = 'mavis', stateFile = None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.stateFile = stateFile or os.path.join(self.stateRoot, 'mavis-%s' % getpass.getuser(), '%s-ratelimit' % name)
+        self.__private = stateFile is None
+        self.__tokens = self.burst
+        self.__updated = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+            Block until a token is available, then take it.
+        """
+
+        started = None
+        while True:
+            wait = self.__take()
+            if not wait: break
+
+            if started is None: started = time.time()
+            time.sleep(wait)
+
+        if started is not None:
+            self.waits += 1
+            self.waited += time.time() - started
+
+    def __take(self):
+        """
+            Take a token, returning 0 - or the seconds until one is available.
+        """
+
+        with self.__lock:
+            if fcntl is None: return self.__refill(self.__state.pack(self.__tokens, self.__updated), None)
+
+            descriptor = self.__open()
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                return self.__refill(os.read(descriptor, self.__state.size), descriptor)
+            finally:
+                os.close(descriptor)
+
+    def __open(self):
+        """
+            Open (or create) the state file - refusing symlinks and other users' files,
+            which would let them spend (or starve) this user's budget.
+        """
+
+        directory = os.path.dirname(self.stateFile)
+        try:
+            os.makedirs(directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST: raise
+
+        # stateRoot is shared - the per-user directory may have been planted by another user.
+        if self.__private:
+            status = os.lstat(directory)
+            if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0077:
+                raise MavisError('Rate limit state directory %s is not private to this user.' % directory)
+
+        try:
+            descriptor = os.open(self.stateFile, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+        except OSError as e:
+            if e.errno != errno.ELOOP: raise
+            raise MavisError('Rate limit state file %s is a symlink.' % self.stateFile)
+
+        if os.fstat(descriptor).st_uid != os.getuid():
+            os.close(descriptor)
+            raise MavisError('Rate limit state file %s is not owned by this user.' % self.stateFile)
+
+        return descriptor
+
+    def __refill(self, state, descriptor):
+        now = time.time()
+
+        # an empty (new) or corrupt file starts with a full bucket.
+        if len(state) == self.__state.size: tokens, updated = self.__state.unpack(state)
+        else: tokens, updated = self.burst, now
+
+        tokens = min(self.burst, tokens + max(0, now - updated) * self.rate)
+
+        wait = 0
+        if tokens >= 1: tokens -= 1
+        else: wait = (1 - tokens) / self.rate
+
+        self.__tokens, self.__updated = tokens, now
+        if descriptor is not None:
+            os.lseek(descriptor, 0, os.SEEK_SET)
+            os.write(descriptor, self.__state.pack(tokens, now))
+
+        return wait
+
+class MavisRetry(object):
+    """
+        Retry policy for idempotent Mavis requests that fail to connect, time out or
+        receive a transient (502/503/504) response.
+
+        Waits between attempts grow exponentially from `backoff` seconds up to
+        `maxBackoff`, with full jitter so many clients do not retry in step.
+    """
+
+    retries = 0
+    """Number of retries performed."""
+
+    def __init__(self, attempts = 3, backoff = 0.5, maxBackoff = 10, methods = ('get', 'put', 'delete')):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.methods = methods
+
+    def allows(self, method, attempt):
+        return method in self.methods and attempt < self.attempts
+
+    def wait(self, attempt):
+        self.retries += 1
+        time.sleep(random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt)))
+
+class MavisCircuitBreaker(object):
+    """
+        Fail fast while Mavis is down.
+
+        After `threshold` consecutive transient failures the breaker opens and every
+        request raises MavisError(503) without touching the network. After `resetTimeout`
+        seconds a single trial request is let through - success closes the breaker,
+        failure re-opens it.
+    """
+
+    trips = 0
+    """Number of times the breaker has opened."""
+
+    rejected = 0
+    """Number of requests refused while open."""
+
+    def __init__(self, threshold = 5, resetTimeout = 30):
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.__failures = 0
+        self.__openedAt = None
+        self.__trial = False
+        self.__lock = threading.Lock()
+
+    def allow(self):
+        """
+            Raise MavisError if the breaker is open.
+        """
+
+        with self.__lock:
+            if self.__openedAt is None: return
+
+            # half-open: let exactly one request test the water.
+            if not self.__trial and time.time() - self.__openedAt >= self.resetTimeout:
+                self.__trial = True
+                return
+
+            self.rejected += 1
+
+        raise MavisError(503, 'Circuit Open - Mavis is failing, not sending requests for up to %s seconds.' % self.resetTimeout)
+
+    def record(self, success):
+        with self.__lock:
+            if success:
+                self.__failures = 0
+                self.__openedAt = None
+                self.__trial = False
+                return
+
+            self.__failures += 1
+            if self.__trial or (self.__openedAt is None and self.__failures >= self.threshold):
+                self.__openedAt = time.time()
+                self.__trial = False
+                self.trips += 1
+
+    def isOpen(self):
+        return self.__openedAt is not None
+
+class MavisCache(object):
+    """
+        Size-bounded, least-recently-used cache of Mavis GET responses.
+
+        Entries expire `ttl` seconds after they are stored. Any write to a path
+        invalidates cached reads of that path, its parents and its children.
+    """
+
+    hits = 0
+    """Number of GETs served from the cache."""
+
+    misses = 0
+    """Number of GETs that had to go to Mavis."""
+
+    def __init__(self, size = 256, ttl = 30):
+        self.size = size
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def key(self, path, params):
+        return (path, json.dumps(params, sort_keys = True))
+
+    def get(self, key):
+        """
+            Return the cached response for key, or None if missing or expired.
+        """
+
+        with self.__lock:
+            try:
+                expires, resp = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expires < time.time():
+                self.misses += 1
+                return None
+
+            # re-insert to mark as most recently used.
+            self.__entries[key] = (expires, resp)
+            self.hits += 1
+            return resp
+
+    def set(self, key, resp):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.time() + self.ttl, resp)
+
+            while len(self.__entries) > self.size:
+                self.__entries.popitem(last = False)
+
+    def invalidate(self, path):
+        """
+            Drop cached reads of path, its parents and its children.
+        """
+
+        path = path.split('?')[0].rstrip('/') + '/'
+
+        with self.__lock:
+            for key in self.__entries.keys():
+                cachedPath = key[0].split('?')[0].rstrip('/') + '/'
+                if cachedPath.startswith(path) or path.startswith(cachedPath):
+                    del self.__entries[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        """
+            Hit and miss counters, for tuning `size` and `ttl`.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.__entries)}
+
+class MavisValidators(object):
+    """
+        Remembers the ETag / Last-Modified validators (and body) of Mavis GET responses,
+        so unchanged resources can be revalidated with a bodiless 304 response.
+
+        At most `size` responses are kept, least recently used are dropped first.
+    """
+
+    revalidated = 0
+    """Number of GETs answered with 304 and served from the stored body."""
+
+    def __init__(self, size = 256):
+        self.size = size
+        self.__responses = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def key(self, path, params):
+        return (path, json.dumps(params, sort_keys = True))
+
+    def headers(self, key):
+        """
+            Conditional request headers for key - empty if nothing is stored.
+        """
+
+        with self.__lock:
+            resp = self.__responses.get(key)
+
+        headers = {}
+        if resp is not None:
+            if 'etag' in resp.headers: headers['If-None-Match'] = resp.headers['etag']
+            if 'last-modified' in resp.headers: headers['If-Modified-Since'] = resp.headers['last-modified']
+
+        return headers
+
+    def stored(self, key):
+        """
+            Return the stored response for key, marking it as most recently used.
+        """
+
+        with self.__lock:
+            resp = self.__responses.pop(key, None)
+            if resp is not None:
+                self.__responses[key] = resp
+                self.revalidated += 1
+
         return resp
 
+    def store(self, key, resp):
+        """
+            Keep resp if Mavis sent a validator for it.
+        """
+
+        if 'etag' not in resp.headers and 'last-modified' not in resp.headers:
+            return
+
+        with self.__lock:
+            self.__responses.pop(key, None)
+            self.__responses[key] = resp
+
+            while len(self.__responses) > self.size:
+                self.__responses.popitem(last = False)
+
 class MavisError(Exception):
     """Pass through class to easily identify MavisErrors"""
 
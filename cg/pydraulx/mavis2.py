@@ -3,6 +3,7 @@
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
 class Mavis(object):
@@ -10,15 +11,27 @@ class Mavis(object):
     session = None
     """The encrypted session cookie identifying this particular Mavis instance."""
 
+    http = None
+    """A pooled, keep-alive requests.Session shared by every query of this Mavis instance."""
+
+    timeout = 30
+    """Seconds to wait for Mavis to respond before raising MavisError."""
+
     #def __init__(self, username, password, host = 'snake', port = '80', loginUrl = 'users/login'):
-    def __init__(self, username, password, host = 'atrophy', port = '3000', loginUrl = 'users/login'):
+    def __init__(self, username, password, host = 'atrophy', port = '3000', loginUrl = 'users/login',
+                 poolSize = 10, timeout = 30):
         """
             Please see the docs concerning Mavis authentication.
+
+            `poolSize` is the number of keep-alive connections kept open to Mavis,
+            `timeout` the number of seconds to wait on any single request.
         """
         
         self.host = host
         self.port = port
         self.username = username
+        self.timeout = timeout
+        self.http = self._createSession(poolSize)
         self.queryBase=r"http://atrophy:3000/api"
         '''
         conn.insert('/models/plates', ('name':'plates', 'input':{}, 'working':{}, 'output':{}  } )
@@ -33,7 +46,7 @@ class Mavis(object):
         http://atrophy:3000/api/TemplateSchemas?filter[where][name]=cameras&filter[include]=fields
         '''
         payload = {"username": username, "password": password, "ttl": 1209600000}
-        response = requests.post("http://atrophy:3000/api/users/login", payload)
+        response = self.http.post("http://atrophy:3000/api/users/login", payload, timeout = self.timeout)
         self.login = response.json()
         print self.login['id']
         #self.query('post', loginUrl, {'password':password, 'username': username})
@@ -69,6 +82,24 @@ class Mavis(object):
         return self.query('put', '/action/%s/%s' % (action, path), data = data).json()
 
 
+    def close(self):
+        """
+            Close all pooled connections to Mavis.
+        """
+        self.http.close()
+
+    def _createSession(self, poolSize):
+        """
+            Build the keep-alive session all queries share, so sequential calls reuse
+            open connections instead of paying for a new TCP handshake each time.
+        """
+
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections = poolSize, pool_maxsize = poolSize)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
+
     def query(self, method, path, data = None, **params):
         """
             Perform the Mavis query.
@@ -87,14 +118,18 @@ class Mavis(object):
         url = ''.join(['http://', self.host, ':', self.port, "/api", path, "?", self.login['id']])
         print url
         try:
-            resp = getattr(requests, method)(
+            resp = self.http.request(
+                method,
                 url,
                 data            = data,
                 params          = params,
                 allow_redirects = False,
                 cookies         = None,
-                headers         = {'content-type': contentType}
+                headers         = {'content-type': contentType},
+                timeout         = self.timeout
             )
+        except requests.exceptions.Timeout:
+            raise MavisError('Timed Out - Mavis did not respond within %s seconds.' % self.timeout)
         except requests.exceptions.ConnectionError:
             raise MavisError('Connection Refused - Mavis may be offline or unreachable.')
         except Exception as e:
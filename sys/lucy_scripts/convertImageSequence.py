@@ -49,7 +49,7 @@ $ nuke -t /hdx/cg/lucy/scripts/convertImageSequence.py \
 /hdx/cg/scripts/nuke8args /hdx/sys/lucy_scripts/convertImageSequence.py --source /mnt/x1/hdx/cg/maya/scripts/hdxBrowser/trevorDev/testPlate --entity /projects/mavisTesting/shot/sh_ot1_012/plates/client1 --start 1001 --end null
 '''
 
-conn = mavis.Mavis('superuser', 'password')
+conn = mavis.Mavis('superuser', 'password', cache = mavis.MavisCache(), persistSession = True)
 #project defaults os a dict of external default values to be stored (somewhere) for plates.
 #These are cascading /facility/project/shot values for entity (plate) settings
 PROJECT_DEFAULTS = {'colorspace': 'Linear', 'xResolution': 1080, 'yResolution': 1080, 'pixelAspect': 1, 'filter': 0, 'CDL': 0}